@@ -0,0 +1,433 @@
+"""
+Medic Assistant etalonai (benchmarks).
+Naudojimas:
+  python bench.py router
+  python bench.py load --users 50 --rounds 20 --openai-latency 0.5 --stream
+  python bench.py startup -n 10
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from types import SimpleNamespace
+
+SAMPLES = [
+    "Sukurk testas apie anemiją",
+    "Paaiškink EKG interpretaciją ir QT intervalą",
+    "flashcards: širdies nepakankamumas",
+    "10.1056/NEJMoa2034577",
+    "Kokia normali hemoglobino koncentracija moterims? " * 4,
+]
+LEGACY_INTENTS = [
+    ("quiz", ["testas", "užduotys", "pasitikrink"]),
+    ("flashcards", ["flashcards", "kortelės", "atmintinė"]),
+    ("notes", ["konspektas", "santrauka", "paaiškink"]),
+]
+
+
+def legacy_route(text: str, intents=LEGACY_INTENTS) -> tuple[str | None, str]:
+    """Senasis handle_message maršrutas: any(k in low) + regex kompiliavimas kiekvienam kvietimui."""
+    low = text.lower()
+    for name, words in intents:
+        if any(k in low for k in words):
+            pattern = "|".join(re.escape(k) for k in words)
+            return name, re.sub(pattern, "", text, flags=re.I).strip(" ,.-:")
+    if re.match(r"^10.\d{4,9}/[-._;()/:A-Z0-9]+$", text, re.I):
+        return "literature", text
+    return None, text
+
+
+def bench_router(number: int, extra_intents: int) -> None:
+    import medic_assistant as ma
+
+    # papildomi sintetiniai ketinimai rodo, kaip kaina auga didėjant raktažodžių skaičiui
+    intents = LEGACY_INTENTS + [(f"x{i}", [f"zodis{i}a", f"zodis{i}b", f"zodis{i}c"]) for i in range(extra_intents)]
+    router = ma.IntentRouter()
+    for name, words in intents:
+        router.keywords(name, words)
+    router.pattern("literature", r"^10.\d{4,9}/[-._;()/:A-Z0-9]+$", re.I)
+    for text in SAMPLES:
+        assert router.route(text)[0] == legacy_route(text, intents)[0], text
+    print(f"{len(intents)} intents, {sum(len(w) for _, w in intents)} keywords")
+    for label, fn in (("legacy", lambda t: legacy_route(t, intents)), ("router", router.route)):
+        seconds = timeit.timeit(lambda: [fn(t) for t in SAMPLES], number=number)
+        print(f"{label:8s} {seconds / (number * len(SAMPLES)) * 1e6:8.2f} µs/message")
+
+
+# ───────────────────────────── Load test ─────────────────────────────
+BOT_ID = 1
+BOT_USERNAME = "medic_bot"
+QUESTIONS = [
+    "Kokia normali hemoglobino koncentracija moterims?",
+    "Kaip interpretuoti padidėjusį CRB?",
+    "Kokie yra sepsio kriterijai?",
+    "What are the first-line drugs for hypertension?",
+    "Kada skiriamas D-dimerų tyrimas?",
+]
+TOPICS = ["anemija", "EKG", "diabetas", "astma", "sepsis", "pneumonija"]
+SCENARIOS = {"private": 5, "group": 2, "quiz": 2, "photo": 1}  # santykiniai svoriai
+
+
+def _fake_jpeg(seed: int) -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        return random.Random(seed).randbytes(50_000)
+    img = Image.new("RGB", (1600, 1200), ((seed * 37) % 256, (seed * 91) % 256, 128))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def make_fake_request(latency: float):
+    """Telegram Bot API stand-in: answers every method locally after `latency` seconds."""
+    from telegram.request import BaseRequest
+
+    class FakeTelegramRequest(BaseRequest):
+        def __init__(self):
+            self.calls: dict[str, int] = {}
+            self._message_id = 0
+
+        @property
+        def read_timeout(self) -> float | None:
+            return None
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        def _message(self, params: dict) -> dict:
+            self._message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                "text": params.get("text", ""),
+            }
+
+        async def do_request(self, url, method, request_data=None, *args, **kwargs) -> tuple[int, bytes]:
+            if latency:
+                await asyncio.sleep(latency)
+            if "/file/bot" in url:  # failo atsisiuntimas (getFile → retrieve)
+                seed = int(re.sub(r"\D", "", url.rsplit("/", 1)[-1]) or 0)
+                return 200, await asyncio.to_thread(_fake_jpeg, seed)  # netrukdome matuoti ciklo vėlavimo
+            name = url.rsplit("/", 1)[-1]
+            self.calls[name] = self.calls.get(name, 0) + 1
+            params = request_data.parameters if request_data else {}
+            if name == "getMe":
+                result = {"id": BOT_ID, "is_bot": True, "first_name": "Medic", "username": BOT_USERNAME}
+            elif name in ("sendMessage", "editMessageText", "sendDocument"):
+                result = self._message(params)
+            elif name == "getFile":
+                file_id = params["file_id"]
+                result = {"file_id": file_id, "file_unique_id": file_id, "file_size": 1, "file_path": f"photos/{file_id}.jpg"}
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return FakeTelegramRequest()
+
+
+class FakeOpenAI:
+    """AsyncOpenAI stand-in with configurable latency and optional streaming."""
+
+    def __init__(self, latency: float, chunks: int):
+        self.latency = latency
+        self.chunks = chunks
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def _text(self, messages: list[dict]) -> str:
+        prompt = str(messages[-1]["content"])
+        if '"questions"' in prompt:
+            return json.dumps({"questions": [
+                {"q": f"Klausimas {i}?", "options": ["Taip", "Ne", "Nežinoma"], "answer": i % 3, "explanation": "Nes."}
+                for i in range(3)
+            ]}, ensure_ascii=False)
+        return "Sintetinis atsakymas. " * 40
+
+    async def close(self) -> None:
+        pass
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        text = self._text(messages)
+        usage = SimpleNamespace(prompt_tokens=200, completion_tokens=len(text) // 4, total_tokens=200 + len(text) // 4)
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+        return self._stream(text, usage)
+
+    async def _stream(self, text: str, usage):
+        step = max(1, len(text) // self.chunks)
+        for i in range(0, len(text), step):
+            await asyncio.sleep(self.latency / self.chunks)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[i:i + step]))], usage=None)
+        yield SimpleNamespace(choices=[], usage=usage)
+
+
+def _percentiles(samples: list[float]) -> str:
+    if len(samples) < 2:
+        return f"n={len(samples)}"
+    q = statistics.quantiles(samples, n=100)
+    return f"n={len(samples):5d}  p50={q[49] * 1e3:8.1f}  p95={q[94] * 1e3:8.1f}  p99={q[98] * 1e3:8.1f} ms"
+
+
+def _deep_size(obj, seen: set | None = None) -> int:
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(v, seen) for v in obj)
+    elif hasattr(obj, "__dict__"):
+        size += _deep_size(vars(obj), seen)
+    return size
+
+
+def _global_sizes(ma) -> dict[str, tuple[int, int]]:
+    sizes = {name: (len(table), _deep_size(dict(table))) for name, table in ma.storage.tables.items()}
+    sizes["response_cache"] = (len(ma.response_cache._mem), _deep_size(ma.response_cache._mem))
+    sizes["analytics.rollups"] = (len(ma.analytics.rollups), _deep_size(ma.analytics.rollups))
+    return sizes
+
+
+class LoadTest:
+    def __init__(self, ma, app, users: int, rounds: int):
+        self.ma = ma
+        self.app = app
+        self.users = users
+        self.rounds = rounds
+        self.handler_times: dict[str, list[float]] = {}
+        self.step_times: dict[str, list[float]] = {}
+        self.lag: list[float] = []
+        self.errors = 0
+        self.processed = 0
+        self._pending: dict[int, asyncio.Future] = {}
+        self._update_id = 0
+        self._photo_id = 0
+
+    def instrument(self) -> None:
+        from telegram import Update
+        from telegram.ext import TypeHandler
+
+        for handler in self.ma.iter_handlers(self.app):
+            handler.callback = self._timed(handler.callback)
+
+        async def done(update, context):
+            self.processed += 1
+            fut = self._pending.pop(update.update_id, None)
+            if fut is not None and not fut.done():
+                fut.set_result(None)
+
+        async def on_error(update, context):
+            self.errors += 1
+
+        self.app.add_handler(TypeHandler(Update, done), group=100)
+        self.app.add_error_handler(on_error)
+
+    def _timed(self, fn):
+        samples = self.handler_times.setdefault(fn.__name__, [])
+
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await fn(update, context)
+            finally:
+                samples.append(time.perf_counter() - started)
+        return wrapper
+
+    async def _send(self, kind: str, user_id: int, chat_id: int, text: str | None = None, photo: bool = False) -> None:
+        from telegram import Update
+
+        self._update_id += 1
+        message = {
+            "message_id": self._update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo:
+            self._photo_id += 1
+            file_id = f"p{self._photo_id}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1600, "height": 1200}]
+        update = Update.de_json({"update_id": self._update_id, "message": message}, self.app.bot)
+        fut = self._pending[self._update_id] = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        await self.app.update_queue.put(update)
+        await fut
+        self.step_times.setdefault(kind, []).append(time.perf_counter() - started)
+
+    async def _user(self, user_id: int) -> None:
+        rnd = random.Random(user_id)
+        self.ma.user_tiers[user_id] = 3  # be dienos limitų
+        for _ in range(self.rounds):
+            scenario = rnd.choices(list(SCENARIOS), weights=list(SCENARIOS.values()))[0]
+            if scenario == "private":
+                await self._send("private", user_id, user_id, rnd.choice(QUESTIONS))
+            elif scenario == "group":
+                await self._send("group", user_id, -1000 - user_id % 5, f"@{BOT_USERNAME} {rnd.choice(QUESTIONS)}")
+            elif scenario == "quiz":
+                await self._send("/quiz", user_id, user_id, "/quiz")
+                await self._send("quiz topic", user_id, user_id, rnd.choice(TOPICS))
+                await self._send("/answer", user_id, user_id, "/answer")
+                await self._send("answers", user_id, user_id, " ".join(rnd.choice("ABC") for _ in range(3)))
+            else:
+                await self._send("photo", user_id, user_id, photo=True)
+
+    async def _watch_loop(self, interval: float = 0.01) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lag.append(time.perf_counter() - started - interval)
+
+    async def run(self) -> float:
+        watcher = asyncio.create_task(self._watch_loop())
+        started = time.perf_counter()
+        await asyncio.gather(*(self._user(10_000 + i) for i in range(self.users)))
+        elapsed = time.perf_counter() - started
+        watcher.cancel()
+        return elapsed
+
+
+async def _load(args) -> None:
+    import medic_assistant as ma
+
+    fake_openai = ma.client = FakeOpenAI(args.openai_latency, args.stream_chunks)
+    request = make_fake_request(args.telegram_latency)
+    app = ma.build_application("123:bench", request=request, get_updates_request=make_fake_request(0))
+    test = LoadTest(ma, app, args.users, args.rounds)
+    test.instrument()
+    await app.initialize()
+    await ma.post_init(app)
+    await app.start()
+    before = _global_sizes(ma)
+    try:
+        elapsed = await test.run()
+    finally:
+        await app.stop()
+        await ma.post_shutdown(app)
+        await app.shutdown()
+    after = _global_sizes(ma)
+
+    print(f"{test.processed} updates in {elapsed:.2f}s → {test.processed / elapsed:.1f} updates/s "
+          f"({args.users} users × {args.rounds} rounds, {test.errors} errors)")
+    print(f"OpenAI calls: {fake_openai.calls}, Telegram API calls: {sum(request.calls.values())} {request.calls}")
+    print("\nPer handler:")
+    for name, samples in sorted(test.handler_times.items()):
+        if samples:
+            print(f"  {name:22s} {_percentiles(samples)}")
+    print("\nPer step (queue → done):")
+    for name, samples in sorted(test.step_times.items()):
+        print(f"  {name:22s} {_percentiles(samples)}")
+    print(f"\nEvent-loop lag: {_percentiles(test.lag)}, max={max(test.lag, default=0) * 1e3:.1f} ms")
+    print("\nGlobal state growth (keys, bytes):")
+    for name, (keys, size) in after.items():
+        keys0, size0 = before.get(name, (0, 0))
+        if (keys, size) != (keys0, size0):
+            print(f"  {name:22s} {keys0:6d} → {keys:6d} keys  {size0 / 1024:9.1f} → {size / 1024:9.1f} KiB")
+
+
+def bench_load(args) -> None:
+    # Etalonas nelieka tikrų duomenų: visi failai laikinoje direktorijoje, jokių išorinių kanalų
+    tmp = tempfile.mkdtemp(prefix="medic_bench_")
+    for key, value in {
+        "TELEGRAM_TOKEN": "123:bench",
+        "OPENAI_API_KEY": "bench",
+        "STORAGE_DB_PATH": os.path.join(tmp, "storage.sqlite"),
+        "HISTORY_DIR": os.path.join(tmp, "history"),
+        "ANALYTICS_LOG_PATH": os.path.join(tmp, "analytics.jsonl"),
+        "CONTENT_LIBRARY_PATH": os.path.join(tmp, "content.sqlite"),
+        "QUOTA_BACKEND": "memory",
+        "GUIDELINE_FEEDS": "",
+        "METRICS_PORT": "0",
+        "PRECOMPUTE_INTERVAL": "0",
+        "LOG_LEVEL": "WARNING",
+        "STREAM_REPLIES": "1" if args.stream else "0",
+        "OPENAI_RPM": "1000000",
+        "OPENAI_TPM": "1000000000",
+    }.items():
+        os.environ.setdefault(key, value)
+    asyncio.run(_load(args))
+    print(f"\nData: {tmp}")
+
+
+# ─────────────────────────────── Startup ───────────────────────────────
+_STARTUP_SCRIPT = """
+import time
+t0 = time.perf_counter()
+import medic_assistant as ma
+t1 = time.perf_counter()
+ma.build_application("123:bench")
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t0)
+"""
+
+
+def bench_startup(number: int, top: int) -> None:
+    """Cold import and import+build_application times, each in a fresh interpreter."""
+    env = {**os.environ, "TELEGRAM_TOKEN": "123:bench", "OPENAI_API_KEY": "bench"}
+    imports, ready = [], []
+    for _ in range(number):
+        out = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT], env=env, capture_output=True, text=True, check=True)
+        a, b = map(float, out.stdout.split()[-2:])
+        imports.append(a)
+        ready.append(b)
+    print(f"import medic_assistant:   median {statistics.median(imports) * 1e3:7.1f} ms  (min {min(imports) * 1e3:.1f})")
+    print(f"+ build_application():    median {statistics.median(ready) * 1e3:7.1f} ms  (min {min(ready) * 1e3:.1f})")
+    # -X importtime: kumuliatyvus laikas (µs) kiekvienam tiesioginiam medic_assistant importui
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import medic_assistant"], env=env, capture_output=True, text=True, check=True
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].startswith("   ") and not parts[2].startswith("    "):
+            rows.append((int(parts[1]), parts[2].strip()))
+    print(f"\nTop {top} imports pulled in at import time (cumulative):")
+    for us, name in sorted(rows, reverse=True)[:top]:
+        print(f"  {name:30s} {us / 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    router = sub.add_parser("router", help="intent router vs. legacy keyword scan")
+    router.add_argument("-n", "--number", type=int, default=20000)
+    router.add_argument("--extra-intents", type=int, default=0)
+    load = sub.add_parser("load", help="drive the real handlers with fake Telegram/OpenAI backends")
+    load.add_argument("--users", type=int, default=50)
+    load.add_argument("--rounds", type=int, default=10)
+    load.add_argument("--openai-latency", type=float, default=0.5, help="s per completion")
+    load.add_argument("--telegram-latency", type=float, default=0.02, help="s per Bot API call")
+    load.add_argument("--stream", action="store_true", help="STREAM_REPLIES=1")
+    load.add_argument("--stream-chunks", type=int, default=20)
+    startup = sub.add_parser("startup", help="cold import / build_application time in fresh interpreters")
+    startup.add_argument("-n", "--number", type=int, default=10)
+    startup.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+    if args.cmd == "router":
+        bench_router(args.number, args.extra_intents)
+    elif args.cmd == "load":
+        bench_load(args)
+    elif args.cmd == "startup":
+        bench_startup(args.number, args.top)
@@ -4,14 +4,41 @@ Telegram bot: Medic Assistant
 – Administratoriai (ADMIN_IDS) nepatenka į limitus
 Autorė: Generated with ChatGPT o3, 2025-06-20 (merged version)
 """
+from __future__ import annotations
+
 import os
+import sys
 import logging
 import datetime as dt
-import feedparser
 import json
 import base64
 import re
 import asyncio
+import hashlib
+import sqlite3
+import time
+import tempfile
+import io
+import functools
+import contextlib
+import contextvars
+import random
+import heapq
+import bisect
+import logging.handlers
+import multiprocessing
+import queue
+import atexit
+import threading
+import traceback
+from array import array
+from collections import Counter, OrderedDict, deque
+from collections.abc import Iterator
+from urllib.parse import urlsplit
+from urllib.request import url2pathname
+from zoneinfo import ZoneInfo
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
 from telegram import (
     Update,
@@ -19,22 +46,31 @@ from telegram import (
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
 )
-from telegram.ext import (
-    Application,
-    ApplicationBuilder,
-    CommandHandler,
-    MessageHandler,
-    ContextTypes,
-    filters,
-    ConversationHandler,
-)
-from openai import AsyncOpenAI
-from fpdf import FPDF
+from telegram.error import Forbidden, RetryAfter
+from typing import TYPE_CHECKING
+
+# Sunkūs moduliai (openai, telegram.ext, fpdf, feedparser, numpy) importuojami tik prireikus –
+# greitesnis paleidimas ir įrankiai, kuriems jų nereikia
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from telegram.ext import Application, ContextTypes
 # ─────────────────────────── Environment ───────────────────────────
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+client: AsyncOpenAI | None = None  # sukuriamas post_init arba per pirmą kvietimą
+http_client = None  # bendras httpx.AsyncClient kitoms išorinėms užklausoms (RSS ir pan.)
+
+
+@functools.cache
+def _numpy():
+    try:
+        import numpy
+    except ImportError:  # neprivaloma – tendencijos skaičiuojamos ir be jos
+        return None
+    return numpy
+
+
 # ───────────────────────────── Admins ──────────────────────────────
 ADMIN_IDS: list[int] = [712878075]  # ← įrašykite kitus administratorių ID, jei reikia
 # ───────────────────────────── Constants ───────────────────────────
@@ -44,6 +80,14 @@ SYSTEM_PROMPT = (
     "visi atsakymai turi būti pagrįsti tik recenzuotais medicinos šaltiniais: "
     "PubMed, UpToDate, Cochrane, ECDC gairėmis ir SAM.lt rekomendacijomis."
 )
+QUIZ_PROMPT = (
+    "Sukurk 3 pasirenkamo atsakymo klausimus ({level} lygiui) apie: {topic}. "
+    "Grąžink tik JSON be jokio kito teksto: "
+    '{{"questions": [{{"q": "klausimas", "options": ["A variantas", "B variantas", "C variantas"], '
+    '"answer": teisingo varianto indeksas nuo 0, "explanation": "trumpas paaiškinimas"}}]}}'
+)
+QUIZ_LETTERS = "ABCD"
+FLASHCARDS_PROMPT = "Sukurk 5 flashcards tema: {topic}, klausimas ir trumpas atsakymas."
 (
     PROFILE_LANGUAGE,
     PROFILE_COUNTRY,
@@ -61,6 +105,7 @@ SYSTEM_PROMPT = (
     DAILY_GOALS,
     CALM_CHOICE,
 ) = range(15)
+END = -1  # ConversationHandler.END (telegram.ext importuojamas tik build_application)
 # Subscription tiers: 0=Free,1=Basic,2=Pro Student,3=Premium MedTech
 TIER_NAMES: list[str] = [
     "🟢 Free (1 užklausa/d., be PDF)",
@@ -75,29 +120,1241 @@ FEATURE_MIN_TIER = {
     "image_analysis": 3,
     "rooms": 3,
 }
+OPENAI_MODEL = "gpt-4o-mini"
+OPENAI_TEMPERATURE = 0.5
+# Atsakymų talpyklos galiojimas sekundėmis pagal funkciją; 0 = nekešuoti (asmeniniai atsakymai)
+CACHE_TTL: dict[str, int] = {
+    "quiz": 7 * 86400,
+    "flashcards": 7 * 86400,
+    "notes": 7 * 86400,
+    "literature": 30 * 86400,
+    "image": 30 * 86400,
+}
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "2048"))
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH")  # pvz. /var/lib/medic/cache.sqlite; tuščia = tik RAM
+CACHE_DB_MAX_ENTRIES = int(os.getenv("CACHE_DB_MAX_ENTRIES", "50000"))
+# Srautinis atsakymų rodymas redaguojant vieną žinutę (įjungiama STREAM_REPLIES=1)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # s tarp redagavimų
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Naudotojų duomenų saugykla (SQLite WAL, atidėtas paketinis įrašymas)
+STORAGE_DB_PATH = os.getenv("STORAGE_DB_PATH", "medic_assistant.sqlite")
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "5"))  # s
+STORAGE_WARM_DAYS = int(os.getenv("STORAGE_WARM_DAYS", "7"))  # paleidžiant kraunami tik aktyvūs
+STORAGE_IDLE_EVICT = float(os.getenv("STORAGE_IDLE_EVICT", "3600"))  # s be veiklos → iškeliama iš RAM
+# Istorija: paskutiniai įrašai RAM, senesni – į naudotojo segmentų failus diske
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+HISTORY_RAM_LIMIT = int(os.getenv("HISTORY_RAM_LIMIT", "50"))
+HISTORY_SEGMENT_BYTES = int(os.getenv("HISTORY_SEGMENT_BYTES", str(1024 * 1024)))
+HISTORY_PAGE_SIZE = 200
+# Analitika: neapdoroti įvykiai į besisukantį failą, suvestinės – RAM masyvuose
+ANALYTICS_LOG_PATH = os.getenv("ANALYTICS_LOG_PATH", "analytics.jsonl")
+ANALYTICS_LOG_BYTES = int(os.getenv("ANALYTICS_LOG_BYTES", str(10 * 1024 * 1024)))
+ANALYTICS_LOG_BACKUPS = int(os.getenv("ANALYTICS_LOG_BACKUPS", "5"))
+# Gairių RSS šaltiniai: "vardas=url,vardas=url" (url gali būti ir vietinis failas)
+GUIDELINE_FEEDS: dict[str, str] = dict(
+    item.strip().split("=", 1)
+    for item in os.getenv("GUIDELINE_FEEDS", "ecdc=https://www.ecdc.europa.eu/en/latest-news/rss").split(",")
+    if "=" in item
+)
+FEED_REFRESH_INTERVAL = float(os.getenv("FEED_REFRESH_INTERVAL", "1800"))  # s
+FEED_MAX_ENTRIES = 20
+# PDF generavimas atskiruose procesuose su ribota eile
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "2"))
+PDF_QUEUE_SIZE = int(os.getenv("PDF_QUEUE_SIZE", "16"))
+# Priminimai: vienas dispečeris, siuntimas paketais neviršijant Telegram limito
+REMINDER_SEND_RATE = float(os.getenv("REMINDER_SEND_RATE", "25"))  # žinučių/s
+REMINDER_BATCH = 50
+REMINDER_INTERVALS = {"daily": 86400, "weekly": 604800}
+# Dienos limitų apskaita: memory (su Storage) | sqlite | redis (išorinė saugykla, išlieka po perkrovimo)
+QUOTA_BACKEND = os.getenv("QUOTA_BACKEND", "memory")
+QUOTA_DB_PATH = os.getenv("QUOTA_DB_PATH", "quota.sqlite")
+QUOTA_REDIS_URL = os.getenv("QUOTA_REDIS_URL", "redis://localhost:6379/0")
+QUOTA_TZ = ZoneInfo(os.getenv("QUOTA_TZ", "Europe/Vilnius"))  # diena keičiasi vidurnaktį šioje zonoje
+# Pokalbio kontekstas: paskutinės replikos iki žetonų biudžeto, senesnės – santraukoje
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+CONTEXT_SUMMARY_BATCH = int(os.getenv("CONTEXT_SUMMARY_BATCH", "4"))  # iškritusių replikų skaičius santraukai
+CONTEXT_SUMMARY_TOKENS = 300
+# Populiarių testų/kortelių išankstinis generavimas (žemo prioriteto eilėje)
+CONTENT_LIBRARY_PATH = os.getenv("CONTENT_LIBRARY_PATH", "content_library.sqlite")
+PRECOMPUTE_INTERVAL = float(os.getenv("PRECOMPUTE_INTERVAL", "86400"))  # s; 0 = išjungta
+PRECOMPUTE_TOP_N = int(os.getenv("PRECOMPUTE_TOP_N", "50"))
+PRECOMPUTE_MIN_COUNT = int(os.getenv("PRECOMPUTE_MIN_COUNT", "3"))
+PRECOMPUTE_LOOKBACK_DAYS = int(os.getenv("PRECOMPUTE_LOOKBACK_DAYS", "14"))
+# Paleidimo režimas: polling (vienas procesas) arba webhook (vienas ar keli darbininkai)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # viešas adresas, pvz. https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # tikrinamas X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))  # pilna eilė stabdo priėmimą, Telegram kartoja
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+# Keli webhook darbininkai (atskiri procesai už balansuotojo): naudotoją aptarnauja vienas darbininkas –
+# user_id % WEBHOOK_WORKERS, kad pokalbių būsena ir jo eilutės RAM būtų tik ten; svetimą update
+# darbininkas persiunčia savininkui. Darbininkas i klauso WEBHOOK_PORT + i, dalijasi STORAGE_DB_PATH
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_URL = os.getenv("WORKER_URL", "http://127.0.0.1:{port}/{path}")  # {index}, {port}, {path}
+WORKER_FORWARD_TIMEOUT = float(os.getenv("WORKER_FORWARD_TIMEOUT", "120"))  # s; savininkas gali persikrauti
+# OpenAI priėmimo kontrolė: lygiagretumas, RPM/TPM ir pakartojimai (paskyros limitai)
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_PER_USER_CONCURRENCY = int(os.getenv("OPENAI_PER_USER_CONCURRENCY", "2"))
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE = 1.0  # s
+OPENAI_BACKOFF_MAX = 30.0  # s
+OPENAI_MAX_TOKENS = 1500
+# Eilė pagal planą: mokantys aptarnaujami pirmiau; laukimas kelia prioritetą (+1 kas N s)
+PRIORITY_AGING_SECONDS = float(os.getenv("PRIORITY_AGING_SECONDS", "10"))
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)  # s
+# Paveikslai prieš siunčiant į OpenAI sumažinami (reikia Pillow; be jo siunčiamas originalas)
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+IMAGE_DETAIL = os.getenv("IMAGE_DETAIL", "auto")  # low|high|auto
+# Stebėsena: Prometheus formato /metrics tik vietiniame adrese; žurnalas rašomas atskirame sraute
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 = išjungta
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))  # DEBUG/INFO dalis; WARNING+ visada
+# Blokuojantis darbas vykdomas bendruose baseinuose; sargas praneša, kai ciklas užstringa
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", str(min(32, (os.cpu_count() or 1) + 4))))
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", os.getenv("PDF_WORKERS", "2")))
+LOOP_WATCHDOG_INTERVAL = float(os.getenv("LOOP_WATCHDOG_INTERVAL", "0.1"))  # s
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25"))  # s; 0 = išjungta
+# HTTP: bendri jungčių baseinai (keep-alive, HTTP/2 jei įdiegtas h2), atskiri laikai operacijoms
+HTTP2 = os.getenv("HTTP2", "1") == "1"
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))  # s
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", str(CONCURRENT_UPDATES)))
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "10"))
+TELEGRAM_WRITE_TIMEOUT = float(os.getenv("TELEGRAM_WRITE_TIMEOUT", "10"))
+TELEGRAM_MEDIA_WRITE_TIMEOUT = float(os.getenv("TELEGRAM_MEDIA_WRITE_TIMEOUT", "60"))  # PDF, failai
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "5"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "120"))  # ilgi atsakymai ir srautai
+FEED_TIMEOUT = float(os.getenv("FEED_TIMEOUT", "15"))
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)  # s
+# ───────────────────────────── Metrics ─────────────────────────────
+class Histogram:
+    """Fixed-bucket latency histogram with an approximate quantile."""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket containing the q-quantile (inf for the overflow bucket)."""
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return 0.0
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms keyed by name + labels, rendered as Prometheus text."""
+
+    def __init__(self):
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.gauges: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self._collectors: list = []
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name: str, delta: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(value)
+
+    def collector(self, fn):
+        """Register fn() -> iterable of (name, type, labels, value | Histogram), read at scrape time."""
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        samples = [(n, "counter", l, v) for (n, l), v in self.counters.items()]
+        samples += [(n, "gauge", l, v) for (n, l), v in self.gauges.items()]
+        samples += [(n, "histogram", l, h) for (n, l), h in self.histograms.items()]
+        for fn in self._collectors:
+            try:
+                samples += [(n, t, tuple(sorted(l.items())), v) for n, t, l, v in fn()]
+            except Exception as e:
+                logging.error("Metrics collector %s failed: %s", fn.__name__, e)
+        lines, typed = [], set()
+        for name, kind, labels, value in sorted(samples, key=lambda x: (x[0], x[2])):
+            if name not in typed:
+                lines.append(f"# TYPE {name} {kind}")
+                typed.add(name)
+            if kind != "histogram":
+                lines.append(f"{name}{self._labels(labels)} {value}")
+                continue
+            seen = 0
+            for bound, n in zip((*value.buckets, "+Inf"), value.counts):
+                seen += n
+                le = 'le="%s"' % bound
+                lines.append(f"{name}_bucket{self._labels(labels, le)} {seen}")
+            lines.append(f"{name}_sum{self._labels(labels)} {value.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_server(self, host: str, port: int) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self._serve, host, port)
+        logging.info("Metrics on http://%s:%d/metrics", host, port)
+        return server
+
+
+metrics = MetricsRegistry()
+
+
+def instrumented(name: str | None = None):
+    """Decorator for coroutines: latency histogram, in-flight gauge and error counter per op."""
+    def decorate(fn):
+        op = name or fn.__name__
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            metrics.add("medic_in_flight", 1, op=op)
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                metrics.inc("medic_errors_total", op=op)
+                raise
+            finally:
+                metrics.add("medic_in_flight", -1, op=op)
+                metrics.observe("medic_latency_seconds", time.perf_counter() - started, op=op)
+        return wrapper
+    return decorate
+
+
+def record_usage(usage) -> None:
+    """Count OpenAI tokens from resp.usage (None when the API did not report it)."""
+    if usage is None:
+        return
+    metrics.inc("medic_openai_tokens_total", getattr(usage, "prompt_tokens", 0) or 0, kind="prompt")
+    metrics.inc("medic_openai_tokens_total", getattr(usage, "completion_tokens", 0) or 0, kind="completion")
+
+
+# ───────────────────────────── Logging ─────────────────────────────
+class SampleFilter(logging.Filter):
+    """Keep every WARNING+ record and a `rate` share of the rest."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Formatavimas (ir %-argumentų įterpimas) vyksta klausytojo gijoje, ne įvykių cikle
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def queue_logging(logger: logging.Logger, *handlers: logging.Handler) -> logging.Handler:
+    """Attach handlers to logger through a queue drained by a background thread."""
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    handler = _DeferredQueueHandler(q)
+    logger.addHandler(handler)
+    return handler
+
+
+def setup_logging() -> None:
+    """Root logger → stderr through a queue; called once by build_application / CLI, not on import."""
+    root = logging.getLogger()
+    if any(isinstance(h, _DeferredQueueHandler) for h in root.handlers):
+        return
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    root.setLevel(LOG_LEVEL)
+    queue_logging(root, stream).addFilter(SampleFilter(LOG_SAMPLE_RATE))
+    logging.getLogger("httpx").setLevel(max(root.level, logging.WARNING))  # po eilutę kiekvienai užklausai
+
+
+# ──────────────────────── Executors / watchdog ─────────────────────
+# Vienas dydžio ribotas gijų baseinas visam sinchroniniam I/O (taip pat asyncio.to_thread),
+# procesų baseinas – CPU darbui, kuris laiko GIL (FPDF). Abu kuriami prireikus.
+_blocking_pool: ThreadPoolExecutor | None = None
+_process_pool: ProcessPoolExecutor | None = None
+
+
+def blocking_pool() -> ThreadPoolExecutor:
+    global _blocking_pool
+    if _blocking_pool is None:
+        _blocking_pool = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+    return _blocking_pool
+
+
+async def run_blocking(fn, *args):
+    """Run sync fn(*args) on the shared thread pool so the event loop keeps serving updates."""
+    return await asyncio.get_running_loop().run_in_executor(blocking_pool(), fn, *args)
+
+
+def process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # Ne fork: tuo metu jau veikia žurnalo, sargo ir baseinų gijos, o jų užraktai būtų nukopijuoti
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _process_pool
+
+
+async def run_process(fn, *args):
+    """Run picklable fn(*args) on the shared process pool (created on first use).
+
+    A pool whose worker died is unusable for good: drop it and retry once on a fresh one.
+    """
+    global _process_pool
+    for attempt in range(2):
+        pool = process_pool()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            if _process_pool is pool:  # kitas kvietėjas galėjo jį jau pakeisti
+                _process_pool = None
+                pool.shutdown(wait=False, cancel_futures=True)
+            if attempt:
+                raise
+            logging.warning("Process pool broken, starting a new one")
+
+
+def shutdown_executors() -> None:
+    global _blocking_pool, _process_pool
+    for pool in (_process_pool, _blocking_pool):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    _blocking_pool = _process_pool = None
+
+
+class LoopWatchdog:
+    """Heartbeat coroutine measures loop lag; a monitor thread logs the loop's stack when it stalls."""
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.blocked = 0
+        self._beat = time.monotonic()
+        self._loop_thread: int | None = None
+        self._task: asyncio.Task | None = None
+        self._stop = threading.Event()
+        metrics.histograms[("medic_loop_lag_seconds", ())] = Histogram(LOOP_LAG_BUCKETS)
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            metrics.observe("medic_loop_lag_seconds", max(0.0, self._beat - expected))
+
+    def _monitor(self) -> None:
+        reported = None
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.threshold or beat == reported:
+                continue
+            reported = beat  # vienas pranešimas vienam užstrigimui
+            self.blocked += 1
+            metrics.inc("medic_loop_blocked_total")
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(nėra)\n"
+            logging.warning("Event loop blocked for %.2fs; loop thread is at:\n%s", stalled, stack.rstrip())
+
+
+loop_watchdog = LoopWatchdog(LOOP_WATCHDOG_INTERVAL, LOOP_BLOCK_THRESHOLD)
+
+
+# ─────────────────────────── HTTP transport ────────────────────────
+@functools.cache
+def _http2_enabled() -> bool:
+    if not HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401  (httpx[http2])
+    except ImportError:
+        logging.info("h2 not installed, using HTTP/1.1 keep-alive pools")
+        return False
+    return True
+
+
+def _limits(max_connections: int):
+    import httpx
+
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def telegram_requests():
+    """(send pool sized to concurrent updates, small separate long-poll pool) for ApplicationBuilder."""
+    from telegram.request import HTTPXRequest
+
+    http_version = "2" if _http2_enabled() else "1.1"
+    send = HTTPXRequest(
+        connection_pool_size=TELEGRAM_POOL_SIZE,
+        connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=TELEGRAM_READ_TIMEOUT,
+        write_timeout=TELEGRAM_WRITE_TIMEOUT,
+        media_write_timeout=TELEGRAM_MEDIA_WRITE_TIMEOUT,
+        pool_timeout=TELEGRAM_POOL_TIMEOUT,
+        http_version=http_version,
+        httpx_kwargs={"limits": _limits(TELEGRAM_POOL_SIZE)},
+    )
+    # getUpdates laukia iki `timeout` s; PTB tą laiką prideda prie read_timeout
+    poll = HTTPXRequest(
+        connection_pool_size=1,
+        connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+        read_timeout=TELEGRAM_READ_TIMEOUT,
+        pool_timeout=TELEGRAM_POOL_TIMEOUT,
+        http_version=http_version,
+        httpx_kwargs={"limits": _limits(1)},
+    )
+    return send, poll
+
+
+def openai_client() -> AsyncOpenAI:
+    global client
+    if client is None:
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        # Vartai riboja lygiagretumą, todėl tiek jungčių ir užtenka; + atsarga foninėms užduotims
+        transport = DefaultAsyncHttpxClient(
+            limits=_limits(OPENAI_MAX_CONCURRENCY + 4),
+            http2=_http2_enabled(),
+            timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        )
+        client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, http_client=transport)  # pakartojimus valdo OpenAIGate
+    return client
+
+
+def shared_http_client():
+    global http_client
+    if http_client is None:
+        import httpx
+
+        http_client = httpx.AsyncClient(
+            limits=_limits(16), http2=_http2_enabled(), timeout=FEED_TIMEOUT, follow_redirects=True
+        )
+    return http_client
+
+
+async def close_http_clients() -> None:
+    global client, http_client
+    if client is not None:
+        await client.close()
+    if http_client is not None:
+        await http_client.aclose()
+    client = http_client = None
+
+
+# ───────────────────────────── Storage ─────────────────────────────
+def worker_file(path: str, index: int = WORKER_INDEX) -> str:
+    """Per-worker name for a file only one process may append to (analytics.jsonl → analytics.w1.jsonl)."""
+    if WEBHOOK_WORKERS == 1 or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{index}{ext}"
+
+
+class PersistentDict(dict):
+    """dict whose changed keys are remembered and flushed to SQLite by Storage.
+
+    Nested values mutated in place (e.g. ``history.append``) must be marked
+    with ``touch(key)``; ``setdefault`` marks the key itself. A ``counter``
+    table holds numbers that several workers increment: flush adds the local
+    increase to the stored value instead of overwriting it.
+    """
+
+    def __init__(self, name: str, per_user: bool = True, counter: bool = False):
+        super().__init__()
+        self.name = name
+        self.per_user = per_user
+        self.counter = counter
+        self.dirty: set = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.dirty.add(key)
+
+    def setdefault(self, key, default=None):
+        self.dirty.add(key)
+        return super().setdefault(key, default)
+
+    def pop(self, key, *default):
+        self.dirty.add(key)
+        return super().pop(key, *default)
+
+    def touch(self, key) -> None:
+        self.dirty.add(key)
+
+
+class Storage:
+    """Hot set in RAM, write-behind batches to SQLite (WAL) on one worker thread.
+
+    Several worker processes may share a database. Worker ``worker`` of
+    ``workers`` owns the users with ``user_id % workers == worker`` and only
+    loads and writes their rows; ``open`` takes an exclusive lock per worker
+    index, so a second process with the same index fails. Shared tables are
+    changed with ``update`` (atomic across processes) or are counters, and
+    ``refresh`` re-reads them.
+    """
+
+    def __init__(self, path: str, tables: list[PersistentDict], worker: int = 0, workers: int = 1):
+        self.path = path
+        self.tables = {t.name: t for t in tables}
+        self.worker = worker
+        self.workers = workers
+        self._db: sqlite3.Connection | None = None
+        self._lock: sqlite3.Connection | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self._loaded: set[int] = set()
+        self._loading: dict[int, asyncio.Task] = {}
+        self._last_seen: dict[int, float] = {}
+        self._flushing: dict[str, set] = {}  # raktai, kurių įrašymas dar vyksta
+        self._synced: dict[str, dict] = {t.name: {} for t in tables if t.counter}  # skaitiklis → reikšmė DB
+        self._sync = asyncio.Lock()  # flush ir refresh nesikerta skaitiklių bazėse
+        self._task: asyncio.Task | None = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _acquire_lock(self) -> None:
+        # Užraktą atleidžia close() arba OS, jei procesas nutrūksta
+        path = f"{self.path}.lock" if self.workers == 1 else f"{self.path}.w{self.worker}.lock"
+        self._lock = sqlite3.connect(path, timeout=0, isolation_level=None, check_same_thread=False)
+        try:
+            self._lock.execute("BEGIN EXCLUSIVE")
+        except sqlite3.OperationalError:
+            self._lock.close()
+            self._lock = None
+            raise RuntimeError(
+                f"{self.path} is used by another bot process as worker {self.worker}; give each a distinct WORKER_INDEX"
+            ) from None
+
+    def _connect(self) -> None:
+        self._acquire_lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS kv (ns TEXT, key TEXT, value TEXT, updated REAL, "
+            "PRIMARY KEY (ns, key))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS kv_updated ON kv (updated)")
+        # top(): ORDER BY ... LIMIT eina indeksu, be visos lentelės rūšiavimo
+        self._db.execute("CREATE INDEX IF NOT EXISTS kv_number ON kv (ns, CAST(value AS REAL))")
+        self._db.commit()
+
+    def _select_warm(self, since: float, per_user: list[str], shared: list[str]) -> list[tuple[str, str, str]]:
+        """Shared tables plus every per-user row of own users with any row updated since `since`."""
+        users = ",".join("?" * len(per_user)) or "''"
+        marks = ",".join("?" * len(shared)) or "''"
+        return self._db.execute(
+            f"SELECT ns, key, value FROM kv WHERE ns IN ({marks}) OR (ns IN ({users}) AND "
+            f"CAST(key AS INTEGER) % ? = ? AND key IN (SELECT key FROM kv WHERE updated >= ? AND ns IN ({users})))",
+            (*shared, *per_user, self.workers, self.worker, since, *per_user),
+        ).fetchall()
+
+    def _select_ns(self, ns: str) -> list[tuple[str, str]]:
+        return self._db.execute("SELECT key, value FROM kv WHERE ns = ?", (ns,)).fetchall()
+
+    def _select_key(self, key: str) -> list[tuple[str, str]]:
+        return self._db.execute("SELECT ns, value FROM kv WHERE key = ?", (key,)).fetchall()
+
+    def _select_top(self, ns: str, n: int) -> list[tuple[str, str]]:
+        return self._db.execute(
+            "SELECT key, value FROM kv WHERE ns = ? ORDER BY CAST(value AS REAL) DESC LIMIT ?", (ns, n)
+        ).fetchall()
+
+    def _write(self, batch: list[tuple[str, str, str | None]], now: float, adds: list[tuple[str, str, int]] = ()) -> None:
+        with self._db:
+            for ns, key, delta in adds:
+                self._db.execute(
+                    "INSERT INTO kv (ns, key, value, updated) VALUES (?, ?, ?, ?) ON CONFLICT (ns, key) "
+                    "DO UPDATE SET value = CAST(value AS INTEGER) + excluded.value, updated = excluded.updated",
+                    (ns, key, delta, now),
+                )
+            for ns, key, value in batch:
+                if value is None:
+                    self._db.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+                else:
+                    self._db.execute(
+                        "INSERT INTO kv (ns, key, value, updated) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+                        (ns, key, value, now),
+                    )
+
+    def _update(self, ns: str, key: str, fn):
+        self._db.execute("BEGIN IMMEDIATE")  # kiti procesai laukia, kol eilutė perrašyta
+        try:
+            row = self._db.execute("SELECT value FROM kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+            value = fn(json.loads(row[0], object_hook=_json_hook) if row else None)
+            if value is None:
+                self._db.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+            else:
+                self._db.execute(
+                    "INSERT INTO kv (ns, key, value, updated) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+                    (ns, key, json.dumps(value, ensure_ascii=False, default=_json_default), time.time()),
+                )
+        except BaseException:
+            self._db.rollback()
+            raise
+        self._db.commit()
+        return value
+
+    async def open(self) -> None:
+        """Connect and warm-load users active in the last STORAGE_WARM_DAYS days."""
+        await self._run(self._connect)
+        per_user = [name for name, t in self.tables.items() if t.per_user]
+        shared = [name for name, t in self.tables.items() if not t.per_user]
+        # Aktyvus naudotojas kraunamas visas – ir senos eilutės (pvz. planas), kitaip load_user jų nebepaimtų
+        rows = await self._run(self._select_warm, time.time() - STORAGE_WARM_DAYS * 86400, per_user, shared)
+        now = time.monotonic()
+        for ns, key, value in rows:
+            table = self.tables.get(ns)
+            if table is None:
+                continue
+            key = json.loads(key)
+            dict.__setitem__(table, key, json.loads(value, object_hook=_json_hook))
+            if table.counter:
+                self._synced[ns][key] = table[key]
+            if table.per_user:
+                self._loaded.add(key)
+                self._last_seen[key] = now
+        logging.info("Storage warm-loaded %d rows from %s", len(rows), self.path)
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def load_user(self, user_id: int) -> None:
+        """Make sure the user's rows are in RAM before a handler touches them."""
+        self._last_seen[user_id] = time.monotonic()
+        if user_id in self._loaded or self._db is None:
+            return
+        task = self._loading.get(user_id)
+        if task is None:
+            task = self._loading[user_id] = asyncio.ensure_future(self._load(user_id))
+        await asyncio.shield(task)
+
+    async def _load(self, user_id: int) -> None:
+        try:
+            for ns, value in await self._run(self._select_key, json.dumps(user_id)):
+                table = self.tables.get(ns)
+                if table is not None and table.per_user and user_id not in table:
+                    dict.__setitem__(table, user_id, json.loads(value, object_hook=_json_hook))
+            self._loaded.add(user_id)
+        finally:
+            self._loading.pop(user_id, None)
+
+    async def flush(self) -> None:
+        """Write dirty keys in one transaction; if it fails they stay dirty for the next flush."""
+        if self._db is None:
+            return
+        async with self._sync:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        taken = {}
+        for name, table in self.tables.items():
+            if table.dirty:
+                taken[name], table.dirty = table.dirty, set()  # pakeitimai įrašymo metu – į naują aibę
+        self._flushing = taken
+        try:
+            batch, adds, synced = [], [], []
+            for name, keys in taken.items():
+                table = self.tables[name]
+                for key in keys:
+                    value = dict.get(table, key)
+                    if table.counter:
+                        # kiti darbininkai didina tą patį skaitiklį – rašome tik savo prieaugį
+                        delta = (value or 0) - self._synced[name].get(key, 0)
+                        if delta:
+                            adds.append((name, json.dumps(key), delta))
+                            synced.append((name, key, value))
+                        continue
+                    if value is not None:
+                        value = json.dumps(value, ensure_ascii=False, default=_json_default)
+                    batch.append((name, json.dumps(key), value))
+            if batch or adds:
+                await self._run(self._write, batch, time.time(), adds)
+            for name, key, value in synced:
+                self._synced[name][key] = value
+        except BaseException:
+            for name, keys in taken.items():
+                self.tables[name].dirty |= keys
+            raise
+        finally:
+            self._flushing = {}
+
+    async def refresh(self, name: str) -> None:
+        """Re-read a shared table that other workers change too; local unsaved changes are kept."""
+        table = self.tables[name]
+        if self._db is None:
+            return
+        async with self._sync:
+            rows = {
+                json.loads(k): json.loads(v, object_hook=_json_hook) for k, v in await self._run(self._select_ns, name)
+            }
+            if table.counter:
+                synced = self._synced[name]
+                for key, value in rows.items():
+                    dict.__setitem__(table, key, value + dict.get(table, key, 0) - synced.get(key, 0))
+                    synced[key] = value
+                return
+            for key in [k for k in table if k not in rows and k not in table.dirty]:
+                dict.pop(table, key)
+            for key, value in rows.items():
+                if key not in table.dirty:
+                    dict.__setitem__(table, key, value)
+
+    async def update(self, name: str, key, fn):
+        """Atomically replace one row of a shared table with fn(current or None); None deletes it.
+
+        fn runs on the storage thread inside the transaction, so it must not touch the loop.
+        """
+        table = self.tables[name]
+        if self._db is None:
+            value = fn(table.get(key))
+        else:
+            value = await self._run(self._update, name, json.dumps(key), fn)
+        if value is None:
+            dict.pop(table, key, None)
+        else:
+            dict.__setitem__(table, key, value)
+        return value
+
+    async def top(self, name: str, n: int) -> list[tuple]:
+        """Largest numeric values of a table across all users, not only those in RAM.
+
+        Indexed SQL top-n merged with keys not yet written, so no flush is forced.
+        """
+        table = self.tables[name]
+        if self._db is None:
+            return heapq.nlargest(n, table.items(), key=lambda kv: kv[1])
+        pending = table.dirty | self._flushing.get(name, set())
+        rows = await self._run(self._select_top, name, n + len(pending))
+        merged = {json.loads(k): json.loads(v) for k, v in rows}
+        for key in pending | table.dirty:
+            value = dict.get(table, key)
+            if value is None:
+                merged.pop(key, None)
+            else:
+                merged[key] = value
+        return heapq.nlargest(n, merged.items(), key=lambda kv: kv[1])
+
+    def evict_idle(self) -> None:
+        """Drop users idle longer than STORAGE_IDLE_EVICT from RAM (already flushed)."""
+        cutoff = time.monotonic() - STORAGE_IDLE_EVICT
+        per_user = [t for t in self.tables.values() if t.per_user]
+        for user_id, seen in list(self._last_seen.items()):
+            if seen > cutoff or any(user_id in t.dirty for t in per_user):
+                continue
+            for table in per_user:
+                dict.pop(table, user_id, None)
+            self._loaded.discard(user_id)
+            del self._last_seen[user_id]
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(STORAGE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+                self.evict_idle()
+            except Exception as e:
+                logging.error("Storage flush failed: %s", e)
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+        await self.flush()
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        if self._lock is not None:
+            await self._run(self._lock.close)
+            self._lock = None
+        self._executor.shutdown(wait=False)
+
+
+# ─────────────────────────── Time series ───────────────────────────
+class TimeSeries:
+    """Columnar series: sorted epoch-second timestamps (array 'q') and float values (array 'd')."""
+
+    def __init__(self, ts=(), values=()):
+        self.ts = array("q", ts)
+        self.values = array("d", values)
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def append(self, ts: float, value: float) -> None:
+        ts = int(ts)
+        if not self.ts or ts >= self.ts[-1]:
+            self.ts.append(ts)
+            self.values.append(value)
+        else:
+            i = bisect.bisect_right(self.ts, ts)
+            self.ts.insert(i, ts)
+            self.values.insert(i, value)
+
+    def range(self, start: float | None = None, end: float | None = None) -> "TimeSeries":
+        """Points with start <= ts <= end (binary search, no scan)."""
+        lo = 0 if start is None else bisect.bisect_left(self.ts, int(start))
+        hi = len(self.ts) if end is None else bisect.bisect_right(self.ts, int(end))
+        part = TimeSeries()
+        part.ts, part.values = self.ts[lo:hi], self.values[lo:hi]
+        return part
+
+    def since_days(self, days: float) -> "TimeSeries":
+        return self.range(time.time() - days * 86400)
+
+    def mean(self) -> float | None:
+        if not self.values:
+            return None
+        np = _numpy()
+        return float(np.mean(self.values)) if np is not None else sum(self.values) / len(self.values)
+
+    def min_max(self) -> tuple[float, float] | None:
+        return (min(self.values), max(self.values)) if self.values else None
+
+    def rolling_mean(self, window: int) -> array:
+        """Mean of each `window` consecutive points (empty if there are fewer)."""
+        n = len(self.values)
+        if n < window or window < 1:
+            return array("d")
+        np = _numpy()
+        if np is not None:
+            csum = np.cumsum(np.concatenate(([0.0], np.frombuffer(self.values, dtype=np.float64))))
+            return array("d", (csum[window:] - csum[:-window]) / window)
+        out, acc = array("d"), sum(self.values[:window])
+        out.append(acc / window)
+        for i in range(window, n):
+            acc += self.values[i] - self.values[i - window]
+            out.append(acc / window)
+        return out
+
+    def slope_per_day(self) -> float | None:
+        """Least-squares trend in units per day."""
+        n = len(self.ts)
+        if n < 2 or self.ts[0] == self.ts[-1]:
+            return None
+        np = _numpy()
+        if np is not None:
+            x = (np.frombuffer(self.ts, dtype=np.int64) - self.ts[0]) / 86400.0
+            y = np.frombuffer(self.values, dtype=np.float64)
+            return float(np.polyfit(x, y, 1)[0])
+        x = [(t - self.ts[0]) / 86400 for t in self.ts]
+        mx, my = sum(x) / n, sum(self.values) / n
+        var = sum((xi - mx) ** 2 for xi in x)
+        return sum((xi - mx) * (yi - my) for xi, yi in zip(x, self.values)) / var
+
+    def to_json(self) -> dict:
+        # Laikai saugomi kaip skirtumai – JSON gerokai trumpesnis
+        deltas = [self.ts[0]] + [b - a for a, b in zip(self.ts, self.ts[1:])] if self.ts else []
+        return {"__ts__": deltas, "v": list(self.values)}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "TimeSeries":
+        ts, acc = [], 0
+        for d in data["__ts__"]:
+            acc += d
+            ts.append(acc)
+        return cls(ts, data["v"])
+
+
+def _json_default(obj):
+    if isinstance(obj, TimeSeries):
+        return obj.to_json()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def _json_hook(obj: dict):
+    return TimeSeries.from_json(obj) if "__ts__" in obj else obj
+
+
+# ──────────────────────────── Analytics ────────────────────────────
+class Rollup:
+    """Event counts in fixed ring buffers: per minute (1 h), per hour (7 d), per day (90 d)."""
+
+    SPANS = {"minute": (60, 60), "hour": (3600, 168), "day": (86400, 90)}
+
+    def __init__(self):
+        self._counts = {name: array("L", [0]) * n for name, (_, n) in self.SPANS.items()}
+        self._buckets = {name: array("q", [-1]) * n for name, (_, n) in self.SPANS.items()}
+
+    def add(self, ts: float, n: int = 1) -> None:
+        for name, (width, size) in self.SPANS.items():
+            bucket = int(ts // width)
+            i = bucket % size
+            if self._buckets[name][i] > bucket:
+                continue  # senesnis nei žiedo langas
+            if self._buckets[name][i] != bucket:
+                self._buckets[name][i] = bucket
+                self._counts[name][i] = 0
+            self._counts[name][i] += n
+
+    def total(self, span: str, last: int, now: float | None = None) -> int:
+        """Sum of the last `last` buckets of `span` (bounded by the ring size)."""
+        width, size = self.SPANS[span]
+        current = int((now or time.time()) // width)
+        buckets, counts = self._buckets[span], self._counts[span]
+        return sum(counts[i] for i in range(size) if current - min(last, size) < buckets[i] <= current)
+
+
+class AnalyticsStore:
+    """Running per-user/per-feature counters plus time rollups; raw events go to a rotating file."""
+
+    def __init__(self, user_totals: dict[int, int], feature_totals: dict[str, int], log_path: str | None):
+        self.user_totals = user_totals
+        self.feature_totals = feature_totals
+        self.log_path = log_path
+        self.rollups: dict[str, Rollup] = {"*": Rollup()}
+        self._events = logging.getLogger("medic.analytics")
+        self._events.propagate = False
+
+    def open(self) -> None:
+        """Start writing raw events (file and writer thread are created here, not at import)."""
+        if not self.log_path or self._events.handlers:
+            return
+        handler = logging.handlers.RotatingFileHandler(
+            self.log_path, maxBytes=ANALYTICS_LOG_BYTES, backupCount=ANALYTICS_LOG_BACKUPS, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        queue_logging(self._events, handler)
+        self._events.setLevel(logging.INFO)
+
+    def record(self, user_id: int, feature: str, **extra) -> None:
+        now = time.time()
+        self.user_totals[user_id] = self.user_totals.get(user_id, 0) + 1
+        self.feature_totals[feature] = self.feature_totals.get(feature, 0) + 1
+        self.rollups["*"].add(now)
+        self.rollups.setdefault(feature, Rollup()).add(now)
+        if self._events.handlers:
+            self._events.info(json.dumps({"user": user_id, "feature": feature, "time": now, **extra}, ensure_ascii=False))
+
+
+# ───────────────────────────── Feeds ───────────────────────────────
+class FeedCache:
+    """RSS feeds refreshed in the background with conditional GETs; parsed entries kept in RAM."""
+
+    def __init__(self, feeds: dict[str, str]):
+        self.feeds = feeds
+        self.entries: dict[str, list[dict[str, str]]] = {}
+        self.updated: dict[str, float] = {}
+        self._validators: dict[str, dict[str, str | None]] = {}
+        self._task: asyncio.Task | None = None
+
+    @staticmethod
+    def _parse(content: bytes):
+        import feedparser
+
+        return feedparser.parse(content)
+
+    @staticmethod
+    def _read_local(url: str) -> bytes:
+        path = url2pathname(urlsplit(url).path) if url.startswith("file:") else url
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def _fetch(self, name: str) -> tuple[bytes | None, dict[str, str | None]]:
+        """(body or None on 304 Not Modified, validators for the next conditional GET)."""
+        url = self.feeds[name]
+        if not url.startswith(("http://", "https://")):
+            return await run_blocking(self._read_local, url), {}  # vietinis failas (pvz. testų fiktyvus srautas)
+        validators = self._validators.get(name, {})
+        headers = {
+            header: value
+            for header, value in (("If-None-Match", validators.get("etag")), ("If-Modified-Since", validators.get("modified")))
+            if value
+        }
+        # Per bendrą klientą – jungtis lieka atvira kitam atnaujinimui
+        resp = await shared_http_client().get(url, headers=headers)
+        if resp.status_code == 304:
+            return None, validators
+        resp.raise_for_status()
+        return resp.content, {"etag": resp.headers.get("etag"), "modified": resp.headers.get("last-modified")}
+
+    async def refresh(self, name: str) -> None:
+        try:
+            content, validators = await self._fetch(name)
+            if content is None:
+                self.updated[name] = time.time()
+                return
+            parsed = await run_blocking(self._parse, content)
+        except Exception as e:
+            logging.error("Feed %s refresh failed: %s", name, e)
+            return
+        if not parsed.get("entries"):
+            logging.warning("Feed %s returned no entries: %s", name, parsed.get("bozo_exception"))
+            return
+        self.entries[name] = [
+            {"title": e.get("title", ""), "link": e.get("link", "")}
+            for e in parsed["entries"][:FEED_MAX_ENTRIES]
+        ]
+        self._validators[name] = validators
+        self.updated[name] = time.time()
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.gather(*(self.refresh(name) for name in self.feeds))
+            await asyncio.sleep(FEED_REFRESH_INTERVAL)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+
+feed_cache = FeedCache(GUIDELINE_FEEDS)
+
+
+# ──────────────────────────── Reminders ────────────────────────────
+class ReminderScheduler:
+    """One dispatcher coroutine over a min-heap of due times; reminders persist via Storage.
+
+    With several workers each one keeps and sends only its own users' reminders
+    and hands out ids congruent to its index, so ids never collide.
+    """
+
+    def __init__(self, reminders: "PersistentDict", worker: int = 0, workers: int = 1):
+        self.reminders = reminders
+        self.worker = worker
+        self.workers = workers
+        self._heap: list[tuple[float, int]] = []
+        self._next_id = 1
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._bot = None
+
+    def start(self, bot) -> None:
+        """Rebuild the heap from persisted reminders and start dispatching."""
+        self._bot = bot
+        last = max(self.reminders, default=0)
+        for rid, reminder in list(self.reminders.items()):
+            if reminder["user"] % self.workers != self.worker:
+                dict.pop(self.reminders, rid)  # kito darbininko; DB eilutė lieka
+        self._heap = [(r["due"], rid) for rid, r in self.reminders.items()]
+        heapq.heapify(self._heap)
+        self._next_id = last + 1 + (self.worker - last - 1) % self.workers
+        self._task = asyncio.create_task(self._dispatch_loop())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+    def add(self, user_id: int, chat_id: int, text: str, due: float, interval: int = 0) -> int:
+        rid = self._next_id
+        self._next_id += self.workers
+        self.reminders[rid] = {"user": user_id, "chat": chat_id, "text": text, "due": due, "interval": interval}
+        heapq.heappush(self._heap, (due, rid))
+        self._wake.set()
+        return rid
+
+    def cancel(self, user_id: int, rid: int) -> bool:
+        reminder = self.reminders.get(rid)
+        if reminder is None or reminder["user"] != user_id:
+            return False
+        del self.reminders[rid]  # heap įrašas atmetamas, kai iškyla
+        return True
+
+    def list_for(self, user_id: int) -> list[tuple[int, dict]]:
+        return sorted(
+            ((rid, r) for rid, r in self.reminders.items() if r["user"] == user_id),
+            key=lambda item: item[1]["due"],
+        )
+
+    async def _send(self, rid: int, reminder: dict) -> None:
+        try:
+            await self._bot.send_message(reminder["chat"], reminder["text"])
+        except RetryAfter as e:
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, dt.timedelta) else e.retry_after
+            await asyncio.sleep(delay)
+            await self._send(rid, reminder)
+        except Forbidden:
+            logging.info("Reminder %s dropped: bot blocked in chat %s", rid, reminder["chat"])
+            reminder["interval"] = 0
+        except Exception as e:
+            logging.error("Reminder %s send failed: %s", rid, e)
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            now = time.time()
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < REMINDER_BATCH:
+                due, rid = heapq.heappop(self._heap)
+                reminder = self.reminders.get(rid)
+                if reminder is not None and reminder["due"] == due:
+                    batch.append((rid, reminder))
+            for rid, reminder in batch:
+                await self._send(rid, reminder)
+                await asyncio.sleep(1 / REMINDER_SEND_RATE)
+                if rid not in self.reminders:
+                    continue
+                if reminder["interval"]:
+                    # po prastovos praleistus kartus praleidžiame, grafikas išlieka
+                    due = reminder["due"] + reminder["interval"]
+                    while due <= now:
+                        due += reminder["interval"]
+                    reminder["due"] = due
+                    self.reminders.touch(rid)
+                    heapq.heappush(self._heap, (due, rid))
+                else:
+                    del self.reminders[rid]
+            if batch:
+                continue
+            self._wake.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
 # ───────────────────────────── Globals ─────────────────────────────
-logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(levelname)s %(message)s")
-user_progress: dict[int, int] = {}            # viso užklausų
-user_daily_usage: dict[int, dict[str, int]] = {}  # {'date': YYYY-MM-DD, 'count': n}
-rooms: dict[str, list[int]] = {}
-user_tiers: dict[int, int] = {}               # default → Free
+user_progress: dict[int, int] = PersistentDict("user_progress")            # viso užklausų
+user_daily_usage: dict[int, dict[str, int]] = PersistentDict("user_daily_usage")  # {'date': YYYY-MM-DD, 'count': n}
+rooms: dict[str, list[int]] = PersistentDict("rooms", per_user=False)  # keičiama tik per storage.update
+user_tiers: dict[int, int] = PersistentDict("user_tiers")               # default → Free
 BOT_USERNAME: str | None = None
-user_history: dict[int, list[dict[str, str]]] = {}
-analytics_log: list[dict[str, str]] = []
-health_metrics: dict[int, list[dict[str, float | str]]] = {}
-reminder_tasks: dict[int, list[asyncio.Task]] = {}
-mood_logs: dict[int, list[dict[str, str]]] = {}
-reflect_logs: dict[int, list[dict[str, str]]] = {}
-daily_plans: dict[int, list[dict[str, list[str]]]] = {}
+metrics_server: asyncio.AbstractServer | None = None
+precompute_task: asyncio.Task | None = None
+user_history: dict[int, list[dict[str, str]]] = PersistentDict("user_history")
+usage_totals: dict[int, int] = PersistentDict("usage_totals")
+feature_totals: dict[str, int] = PersistentDict("feature_totals", per_user=False, counter=True)
+analytics = AnalyticsStore(usage_totals, feature_totals, worker_file(ANALYTICS_LOG_PATH))
+health_metrics: dict[int, dict[str, TimeSeries]] = PersistentDict("health_metrics")
+reminders: dict[int, dict] = PersistentDict("reminders", per_user=False)
+reminder_scheduler = ReminderScheduler(reminders, WORKER_INDEX, WEBHOOK_WORKERS)
+conversation_summaries: dict[int, dict] = PersistentDict("conversation_summaries")  # {"text", "until": ts, "reset": ts}
+mood_logs: dict[int, list[dict[str, str]]] = PersistentDict("mood_logs")
+mood_ratings: dict[int, TimeSeries] = PersistentDict("mood_ratings")
+reflect_logs: dict[int, list[dict[str, str]]] = PersistentDict("reflect_logs")
+daily_plans: dict[int, list[dict[str, list[str]]]] = PersistentDict("daily_plans")
+storage = Storage(STORAGE_DB_PATH, [
+    user_progress, user_daily_usage, rooms, user_tiers, user_history,
+    health_metrics, mood_logs, mood_ratings, reflect_logs, daily_plans, usage_totals, feature_totals, reminders,
+    conversation_summaries,
+], WORKER_INDEX, WEBHOOK_WORKERS)
 # ──────────────────────── Helper functions ─────────────────────────
-def detect_language(text: str) -> str:
+# Raidės, kurių neturi jokia kita paplitusi kalba (ą/ę – ir lietuvių, ū – ir latvių, č/š/ž/ó/ć – daugelio);
+# kitais atvejais sprendžia langdetect, o nepalaikomos kalbos gauna anglišką atsakymą
+_LT_ONLY_CHARS = frozenset("ėįų")
+_PL_ONLY_CHARS = frozenset("łśźż")
+_langdetect = None
+
+
+def init_language_detector() -> None:
+    """Load langdetect profiles once and fix its seed so results are deterministic."""
+    global _langdetect
+    if _langdetect is not None:
+        return
     try:
-        from langdetect import detect
-        return detect(text)
+        from langdetect import DetectorFactory, detect
+        from langdetect.detector_factory import init_factory
+        DetectorFactory.seed = 0
+        init_factory()
+        _langdetect = detect
+    except Exception as e:
+        logging.warning("langdetect unavailable, defaulting to en: %s", e)
+        _langdetect = lambda _text: "en"
+
+
+@functools.lru_cache(maxsize=4096)
+def _detect_sample(sample: str) -> str:
+    chars = set(sample)
+    if chars & _LT_ONLY_CHARS:
+        return "lt"
+    if chars & _PL_ONLY_CHARS:
+        return "pl"
+    init_language_detector()
+    try:
+        return _langdetect(sample)
     except Exception:
         return "en"
 
 
+async def detect_language(text: str) -> str:
+    sample = text[:200].lower()
+    if set(sample) & (_LT_ONLY_CHARS | _PL_ONLY_CHARS):
+        return _detect_sample(sample)  # be langdetect, nebrangu
+    return await run_blocking(_detect_sample, sample)
+
+
+async def user_language(context: ContextTypes.DEFAULT_TYPE, text: str) -> str:
+    """Profile language if set; only otherwise detect it from text (langdetect runs off the loop)."""
+    return context.user_data.get("profile", {}).get("language") or await detect_language(text)
+
+
 def lang_prompt(code: str) -> str:
     return {
         "lt": "Atsakyk lietuviškai.",
@@ -120,119 +1377,1180 @@ def lang_prompt(code: str) -> str:
 
 def today_str() -> str:
     return dt.date.today().isoformat()
-def increment_usage(user_id: int) -> bool:
-    """Padidina dienos skaitiklį. Grąžina True, jei dar nepasiektas limitas / admin / neribota."""
+# ────────────────────────────── Quota ──────────────────────────────
+def quota_day() -> str:
+    return dt.datetime.now(QUOTA_TZ).date().isoformat()
+
+
+class MemoryQuota:
+    """Backend over user_daily_usage in the user's own worker; check-and-increment has no await, so it is atomic."""
+
+    def __init__(self, usage: dict[int, dict[str, int]]):
+        self.usage = usage
+
+    async def reserve(self, user_id: int, day: str, quota: int) -> bool:
+        record = self.usage.get(user_id)
+        if record is None or record["date"] != day:
+            record = self.usage[user_id] = {"date": day, "count": 0}
+        if record["count"] >= quota:
+            return False
+        record["count"] += 1
+        self.usage.touch(user_id)
+        return True
+
+    async def refund(self, user_id: int, day: str) -> None:
+        record = self.usage.get(user_id)
+        if record and record["date"] == day and record["count"] > 0:
+            record["count"] -= 1
+            self.usage.touch(user_id)
+
+
+class SQLiteQuota:
+    """Backend shared by processes on one host: a conditional UPSERT is the atomic check-and-increment."""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS quota (user INTEGER, day TEXT, count INTEGER, PRIMARY KEY (user, day))"
+        )
+        self._db.commit()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quota")
+
+    def _reserve(self, user_id: int, day: str, quota: int) -> bool:
+        with self._db:
+            cur = self._db.execute(
+                "INSERT INTO quota (user, day, count) VALUES (?, ?, 1) "
+                "ON CONFLICT (user, day) DO UPDATE SET count = count + 1 WHERE count < ?",
+                (user_id, day, quota),
+            )
+            self._db.execute("DELETE FROM quota WHERE user = ? AND day < ?", (user_id, day))
+        return cur.rowcount == 1
+
+    def _refund(self, user_id: int, day: str) -> None:
+        with self._db:
+            self._db.execute(
+                "UPDATE quota SET count = count - 1 WHERE user = ? AND day = ? AND count > 0", (user_id, day)
+            )
+
+    async def reserve(self, user_id: int, day: str, quota: int) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._reserve, user_id, day, quota)
+
+    async def refund(self, user_id: int, day: str) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._refund, user_id, day)
+
+
+class RedisQuota:
+    """Backend in an external Redis-protocol server (Lua check-and-incr); counts outlive the process."""
+
+    RESERVE = (
+        "local c = tonumber(redis.call('GET', KEYS[1]) or '0') "
+        "if c >= tonumber(ARGV[1]) then return 0 end "
+        "redis.call('INCR', KEYS[1]) redis.call('EXPIRE', KEYS[1], 172800) return 1"
+    )
+    REFUND = "if tonumber(redis.call('GET', KEYS[1]) or '0') > 0 then redis.call('DECR', KEYS[1]) end return 1"
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis  # neprivaloma priklausomybė
+        self._redis = redis.from_url(url)
+
+    async def reserve(self, user_id: int, day: str, quota: int) -> bool:
+        return bool(await self._redis.eval(self.RESERVE, 1, f"quota:{day}:{user_id}", quota))
+
+    async def refund(self, user_id: int, day: str) -> None:
+        await self._redis.eval(self.REFUND, 1, f"quota:{day}:{user_id}")
+
+
+def make_quota_backend():
+    if QUOTA_BACKEND == "sqlite":
+        return SQLiteQuota(QUOTA_DB_PATH)
+    if QUOTA_BACKEND == "redis":
+        return RedisQuota(QUOTA_REDIS_URL)
+    return MemoryQuota(user_daily_usage)
+
+
+quota_backend = make_quota_backend()
+# Paskutinė šio update rezervacija – grąžinama, jei OpenAI kvietimas nepavyksta
+_usage_reservation: contextvars.ContextVar[tuple[int, str] | None] = contextvars.ContextVar(
+    "usage_reservation", default=None
+)
+
+
+async def increment_usage(user_id: int) -> bool:
+    """Rezervuoja vieną dienos užklausą. Grąžina True, jei dar nepasiektas limitas / admin / neribota."""
     if user_id in ADMIN_IDS:
         return True
-    tier = user_tiers.get(user_id, 0)
-    quota = TIER_DAILY_QUOTA[tier]
+    quota = TIER_DAILY_QUOTA[user_tiers.get(user_id, 0)]
     if quota is None:
         return True
-    record = user_daily_usage.setdefault(user_id, {"date": today_str(), "count": 0})
-    if record["date"] != today_str():
-        record["date"] = today_str()
-        record["count"] = 0
-    if record["count"] >= quota:
+    day = quota_day()
+    if not await quota_backend.reserve(user_id, day, quota):
         return False
-    record["count"] += 1
+    _usage_reservation.set((user_id, day))
     return True
+
+
+async def refund_usage() -> None:
+    """Grąžina šio update rezervaciją (pvz., kai modelis neatsakė)."""
+    reservation = _usage_reservation.get()
+    if reservation is not None:
+        _usage_reservation.set(None)
+        try:
+            await quota_backend.refund(*reservation)
+        except Exception as e:
+            logging.error("Quota refund failed: %s", e)
 def has_feature(user_id: int, feature: str) -> bool:
     if user_id in ADMIN_IDS:
         return True
     return user_tiers.get(user_id, 0) >= FEATURE_MIN_TIER.get(feature, 0)
-def save_as_pdf(text: str, filename: str = "document.pdf") -> str:
+def _render_pdf(text: str | None = None, source_path: str | None = None) -> bytes:
+    """Render text (or a UTF-8 text file, line by line) to PDF bytes; runs in a worker process."""
+    from fpdf import FPDF
+
     pdf = FPDF()
     pdf.add_page()
     pdf.set_auto_page_break(auto=True, margin=15)
     pdf.set_font("Arial", size=12)
-    for line in text.split("\n"):
-        pdf.multi_cell(0, 10, line)
-    path = f"/tmp/{filename}"
+    if source_path is not None:
+        with open(source_path, encoding="utf-8") as f:
+            for line in f:
+                pdf.multi_cell(0, 10, line.rstrip("\n"))
+    else:
+        for line in (text or "").split("\n"):
+            pdf.multi_cell(0, 10, line)
+    out = pdf.output(dest="S")
+    return out.encode("latin-1") if isinstance(out, str) else bytes(out)
+
+
+class PdfRenderer:
+    """Bounded queue in front of the shared process pool for FPDF, with render-time stats."""
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.limit = workers + queue_size
+        self.pending = 0
+        self.renders = 0
+        self.render_seconds = 0.0
+        self.max_render_seconds = 0.0
+
+    @property
+    def busy(self) -> bool:
+        return self.pending >= self.limit
+
+    async def render(self, text: str | None = None, source_path: str | None = None) -> bytes | None:
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            return await run_process(_render_pdf, text, source_path)
+        except Exception as e:
+            logging.error("PDF creation failed: %s", e)
+            return None
+        finally:
+            self.pending -= 1
+            elapsed = time.perf_counter() - started
+            self.renders += 1
+            self.render_seconds += elapsed
+            self.max_render_seconds = max(self.max_render_seconds, elapsed)
+
+
+pdf_renderer = PdfRenderer(PDF_WORKERS, PDF_QUEUE_SIZE)
+
+
+@instrumented()
+async def send_pdf(update: Update, filename: str, text: str | None = None, source_path: str | None = None):
+    """Render off-loop and upload straight from memory."""
+    if pdf_renderer.busy:
+        return await update.message.reply_text("⏳ PDF generavimas užimtas, bandyk po minutės.")
+    data = await pdf_renderer.render(text, source_path)
+    if not data:
+        return await update.message.reply_text("❗ Nepavyko sukurti PDF.")
+    await update.message.reply_document(InputFile(io.BytesIO(data), filename=filename))
+
+
+def _history_segments(user_id: int) -> list[str]:
+    folder = os.path.join(HISTORY_DIR, str(user_id))
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, n) for n in sorted(os.listdir(folder)) if n.endswith(".jsonl")]
+
+
+def _spill_history(user_id: int, entries: list[dict[str, str]]) -> None:
+    """Append old entries to the user's newest segment, starting a new one when it is full."""
+    segments = _history_segments(user_id)
+    if not segments or os.path.getsize(segments[-1]) >= HISTORY_SEGMENT_BYTES:
+        folder = os.path.join(HISTORY_DIR, str(user_id))
+        os.makedirs(folder, exist_ok=True)
+        segments.append(os.path.join(folder, f"{len(segments) + 1:06d}.jsonl"))
+    with open(segments[-1], "a", encoding="utf-8") as f:
+        f.writelines(json.dumps(e, ensure_ascii=False) + "\n" for e in entries)
+
+
+def iter_history(user_id: int, recent: list[dict[str, str]], page_size: int = HISTORY_PAGE_SIZE) -> Iterator[list[dict[str, str]]]:
+    """Yield the full history oldest-first in pages: disk segments, then the RAM ring."""
+    page: list[dict[str, str]] = []
+    for path in _history_segments(user_id):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                page.append(json.loads(line))
+                if len(page) >= page_size:
+                    yield page
+                    page = []
+    if page:
+        yield page
+    for i in range(0, len(recent), page_size):
+        yield recent[i:i + page_size]
+
+
+async def has_history(user_id: int) -> bool:
+    return bool(user_history.get(user_id)) or bool(await run_blocking(_history_segments, user_id))
+
+
+# Vykdomi išpylimai (po vieną naudotojui); nuoroda laikoma, kol užduotis baigsis
+_spilling: dict[int, asyncio.Task] = {}
+# Kol eksportas skaito segmentus, naujas išpylimas tam naudotojui nepradedamas
+_exporting: Counter = Counter()
+
+
+async def _spill_oldest(user_id: int, history: list[dict[str, str]], count: int) -> None:
     try:
-        pdf.output(path)
-    except Exception as e:
-        logging.error("PDF creation failed: %s", e)
-        return ""
-    return path
-def log_interaction(user_id: int, question: str, answer: str, feature: str = ""):
-    """Store Q/A pairs for history and analytics."""
+        await run_blocking(_spill_history, user_id, history[:count])
+    except OSError as e:
+        logging.error("History spill failed: %s", e)  # įrašai lieka RAM, bandoma kitą kartą
+    else:
+        del history[:count]  # nauji įrašai tuo metu pridėti gale, pradžia nepakito
+        if user_history.get(user_id) is history:
+            user_history.touch(user_id)
+    finally:
+        _spilling.pop(user_id, None)
+
+
+def log_interaction(user_id: int, question: str, answer: str, feature: str = "", chat_id: int | None = None, **meta):
+    """Store Q/A pairs for history and analytics (meta goes to the raw analytics event)."""
     history = user_history.setdefault(user_id, [])
-    history.append({"q": question, "a": answer})
-    analytics_log.append(
-        {
-            "user": str(user_id),
-            "feature": feature or "message",
-            "time": dt.datetime.now().isoformat(),
-        }
-    )
-def parse_metrics(text: str) -> dict[str, float | str]:
-    """Extract health metrics from arbitrary text."""
-    metrics: dict[str, float | str] = {}
+    entry = {"q": question, "a": answer, "f": feature or "message", "t": time.time()}
+    if entry["f"] == "message":
+        entry["n"] = count_tokens(question) + count_tokens(answer)  # skaičiuojama vieną kartą, ne kiekvienam kontekstui
+        if chat_id is not None:
+            entry["c"] = chat_id
+    history.append(entry)
+    if len(history) > HISTORY_RAM_LIMIT and user_id not in _spilling and not _exporting[user_id]:
+        # išpilame pusę, kad diskas būtų liečiamas retai; failai rašomi ne įvykių cikle
+        count = len(history) - HISTORY_RAM_LIMIT // 2
+        _spilling[user_id] = asyncio.create_task(_spill_oldest(user_id, history, count))
+    analytics.record(user_id, feature or "message", **meta)
+def parse_metrics(text: str) -> dict[str, float]:
+    """Extract health metrics from arbitrary text; blood pressure is split into systolic/diastolic."""
+    metrics: dict[str, float] = {}
     pattern = r"(svoris|kmi|kraujosp\u016bdis|gliukoz\u0117|pulsas|cholesterolis)[:=]?\s*([0-9]+(?:[\.,][0-9]+)?(?:/[0-9]+)?)"
     for key, value in re.findall(pattern, text, re.I):
         key = key.lower()
         value = value.replace(',', '.')
-        if '/' in value:
-            metrics[key] = value
-        else:
-            try:
+        try:
+            if '/' in value:
+                sys_bp, dia_bp = value.split('/', 1)
+                metrics["sistolinis"], metrics["diastolinis"] = float(sys_bp), float(dia_bp)
+            else:
                 metrics[key] = float(value)
-            except ValueError:
-                continue
+        except ValueError:
+            continue
     return metrics
-def strip_keywords(text: str, keywords: list[str]) -> str:
-    """Remove trigger keywords from a message and return the remainder."""
-    pattern = "|".join(re.escape(k) for k in keywords)
-    cleaned = re.sub(pattern, "", text, flags=re.I)
-    return cleaned.strip(" ,.-:")
-async def ask_openai(user_msg: str, lang_code: str) -> str:
-    try:
-        resp = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": f"{lang_prompt(lang_code)} {SYSTEM_PROMPT}"},
-                {"role": "user", "content": user_msg},
-            ],
-            temperature=0.5,
-            max_tokens=1500,
+
+
+def metric_series(user_id: int) -> dict[str, TimeSeries]:
+    """The user's metric series; the old list-of-dicts format is migrated on first access."""
+    data = health_metrics.get(user_id)
+    if isinstance(data, dict):
+        return data
+    series: dict[str, TimeSeries] = {}
+    for entry in data or []:
+        ts = dt.datetime.fromisoformat(entry["date"]).timestamp()
+        values = parse_metrics(" ".join(f"{k}={v}" for k, v in entry.items() if k != "date"))
+        for key, value in values.items():
+            series.setdefault(key, TimeSeries()).append(ts, value)
+    health_metrics[user_id] = series
+    return series
+
+
+def mood_series(user_id: int) -> TimeSeries:
+    """Mood ratings as a series; built once from mood_logs for users logged before it existed."""
+    series = mood_ratings.get(user_id)
+    if series is None:
+        series = TimeSeries()
+        for entry in mood_logs.get(user_id, []):
+            with contextlib.suppress(KeyError, ValueError):
+                series.append(dt.datetime.fromisoformat(entry["date"]).timestamp(), float(entry["rating"]))
+        mood_ratings[user_id] = series
+    return series
+# ───────────────────────── Response cache ──────────────────────────
+class ResponseCache:
+    """LRU cache in RAM with an optional SQLite tier for model replies (queried on its own thread)."""
+
+    def __init__(self, max_entries: int, db_path: str | None = None, db_max_entries: int = 50000):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.db_max_entries = db_max_entries
+        self.hits = 0
+        self.misses = 0
+        self._mem: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._db: sqlite3.Connection | None = None
+        self._db_writes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+
+    @staticmethod
+    def make_key(prompt: str, lang_code: str, model: str, temperature: float) -> str:
+        normalized = " ".join(prompt.lower().split()).strip(" ,.-:?!")
+        raw = json.dumps([normalized, lang_prompt(lang_code), model, temperature], ensure_ascii=False)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, value TEXT)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _select(self, key: str) -> tuple[float, str] | None:
+        return self._connect().execute(
+            "SELECT expires, value FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+
+    def _insert(self, key: str, expires: float, value: str) -> None:
+        db = self._connect()
+        db.execute(
+            "INSERT OR REPLACE INTO responses (key, expires, value) VALUES (?, ?, ?)",
+            (key, expires, value),
+        )
+        self._db_writes += 1
+        if self._db_writes % 256 == 0:
+            self._prune_db()
+        db.commit()
+
+    async def get(self, key: str) -> str | None:
+        now = time.time()
+        item = self._mem.get(key)
+        if item is not None:
+            if item[0] > now:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            del self._mem[key]
+        if self.db_path:
+            row = await self._run(self._select, key)
+            if row and row[0] > now:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                return row[1]
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        expires = time.time() + ttl
+        self._remember(key, expires, value)
+        if self.db_path:
+            await self._run(self._insert, key, expires, value)
+
+    def _remember(self, key: str, expires: float, value: str) -> None:
+        self._mem[key] = (expires, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def _prune_db(self) -> None:
+        self._db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            " SELECT key FROM responses ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.db_max_entries,),
         )
-        return resp.choices[0].message.content
+
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_DB_PATH, CACHE_DB_MAX_ENTRIES)
+
+
+# ─────────────────────────── Intent router ─────────────────────────
+class IntentRouter:
+    """Keyword intents compiled into one trie-shaped regex; earlier registrations win.
+
+    ``route`` returns the intent and the message with that intent's keywords
+    removed in a single scan; whole-message patterns are tried after keywords.
+    """
+
+    def __init__(self):
+        self._intents: list[str] = []
+        self._owner: dict[str, int] = {}  # raktažodis (mažosiomis) → ketinimo indeksas
+        self._patterns: list[tuple[str, re.Pattern]] = []
+        self._matcher: re.Pattern | None = None
+        self._matcher_i: re.Pattern | None = None
+
+    def keywords(self, name: str, words: list[str]) -> None:
+        self._intents.append(name)
+        for word in words:
+            self._owner.setdefault(word.lower(), len(self._intents) - 1)
+        self._matcher = None
+
+    def pattern(self, name: str, regex: str, flags: int = 0) -> None:
+        self._patterns.append((name, re.compile(regex, flags)))
+
+    @staticmethod
+    def _trie_regex(node: dict) -> str:
+        # prefiksų medis → (?:a(?:b|c)|d): re variklis šakojasi pagal pirmą simbolį
+        end = "" in node
+        branches = [re.escape(ch) + IntentRouter._trie_regex(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 and not end else "(?:" + "|".join(branches) + ")"
+        return body + "?" if end else body
+
+    def _compile(self) -> re.Pattern:
+        trie: dict = {}
+        for word in self._owner:
+            node = trie
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[""] = {}
+        # ilgiausias atitikmuo: godūs "?" renkasi ilgesnę šaką
+        self._matcher = re.compile(self._trie_regex(trie) or "(?!)")
+        self._matcher_i = re.compile(self._matcher.pattern, re.I)
+        return self._matcher
+
+    def route(self, text: str) -> tuple[str | None, str]:
+        matcher = self._matcher or self._compile()
+        low = text.lower()
+        if len(low) != len(text):  # retas atvejis: lower() pakeitė ilgį, pozicijos nesutaptų
+            matcher, low = self._matcher_i, text
+        spans: dict[int, list[tuple[int, int]]] = {}
+        for m in matcher.finditer(low):
+            spans.setdefault(self._owner[m.group().lower()], []).append(m.span())
+        if spans:
+            best = min(spans)
+            parts, pos = [], 0
+            for start, end in spans[best]:
+                parts.append(text[pos:start])
+                pos = end
+            parts.append(text[pos:])
+            return self._intents[best], "".join(parts).strip(" ,.-:")
+        for name, regex in self._patterns:
+            if regex.match(text):
+                return name, text
+        return None, text
+
+
+intent_router = IntentRouter()
+intent_router.keywords("quiz", ["testas", "užduotys", "pasitikrink"])
+intent_router.keywords("flashcards", ["flashcards", "kortelės", "atmintinė"])
+intent_router.keywords("notes", ["konspektas", "santrauka", "paaiškink"])
+intent_router.pattern("literature", r"^10.\d{4,9}/[-._;()/:A-Z0-9]+$", re.I)
+# ───────────────────────── OpenAI admission ────────────────────────
+# Nustatoma load_user_state prieš kiekvieną update; OpenAIGate pagal tai skirsto vietas
+current_user_id: contextvars.ContextVar[int | None] = contextvars.ContextVar("current_user_id", default=None)
+
+
+class TokenBucket:
+    """Refills `rate` units per second up to `capacity`; acquire() waits when empty."""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        amount = min(amount, self.capacity)
+        self._refill()
+        while self.tokens < amount:
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+@functools.cache
+def _retryable_errors() -> tuple[type[Exception], ...]:
+    from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+    return RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+
+
+def _retry_after(e: Exception) -> float | None:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class PrioritySlots:
+    """Like a Semaphore, but frees slots to the highest (priority + age) waiter, not FIFO."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.active = 0
+        self._queues: dict[int, deque] = {}
+
+    @property
+    def queued(self) -> dict[int, int]:
+        return {p: len(q) for p, q in self._queues.items() if q}
+
+    async def acquire(self, priority: int) -> None:
+        if self.active < self.workers and not any(self._queues.values()):
+            self.active += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        waiters = self._queues.setdefault(priority, deque())
+        item = (time.monotonic(), fut)
+        waiters.append(item)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # vieta jau suteikta, bet laukiantysis atšauktas
+            else:
+                with contextlib.suppress(ValueError):  # release() galėjo jį jau išmesti
+                    waiters.remove(item)
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        now = time.monotonic()
+        while self.active < self.workers:
+            best, best_score = None, None
+            for priority, waiters in self._queues.items():
+                while waiters and waiters[0][1].done():
+                    waiters.popleft()
+                if waiters:
+                    score = priority + (now - waiters[0][0]) / PRIORITY_AGING_SECONDS
+                    if best_score is None or score > best_score:
+                        best, best_score = waiters, score
+            if best is None:
+                return
+            self.active += 1
+            best.popleft()[1].set_result(None)
+
+
+def user_priority(user_id: int | None) -> int:
+    """Admins above Premium above … Free; background work (no user) goes last."""
+    if user_id is None:
+        return -1
+    if user_id in ADMIN_IDS:
+        return len(TIER_NAMES)
+    return user_tiers.get(user_id, 0)
+
+
+def priority_label(priority: int) -> str:
+    if priority < 0:
+        return "background"
+    if priority >= len(TIER_NAMES):
+        return "admin"
+    return TIER_NAMES[priority].split(" (")[0]
+
+
+class OpenAIGate:
+    """Admission control for OpenAI calls: tier-priority slots, RPM/TPM buckets, per-user cap, retries."""
+
+    def __init__(self, max_concurrency: int, per_user: int, rpm: int, tpm: int):
+        self.per_user = per_user
+        self._slots = PrioritySlots(max_concurrency)
+        self.latency: dict[int, Histogram] = {}  # prioritetas → laukimas + vykdymas
+        self._requests = TokenBucket(rpm, rpm / 60)
+        self._tokens = TokenBucket(tpm, tpm / 60)
+        self._users: dict[int, list] = {}  # user → [Semaphore, naudotojų skaičius]
+        self.waiting = 0
+        self.in_flight = 0
+        self.retries = 0
+        self.failures = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, est_tokens: int):
+        """Hold one admitted request slot (also for the whole duration of a stream)."""
+        user_id = current_user_id.get()
+        priority = user_priority(user_id)
+        started = time.perf_counter()
+        entry = None
+        if user_id is not None:
+            entry = self._users.setdefault(user_id, [asyncio.Semaphore(self.per_user), 0])
+            entry[1] += 1
+        self.waiting += 1
+        try:
+            async with (entry[0] if entry else contextlib.nullcontext()):
+                await self._slots.acquire(priority)
+                try:
+                    await self._requests.acquire(1)
+                    await self._tokens.acquire(est_tokens)
+                    self.waiting -= 1
+                    self.in_flight += 1
+                    try:
+                        yield
+                    finally:
+                        self.in_flight -= 1
+                        self.waiting += 1
+                finally:
+                    self._slots.release()
+        finally:
+            self.waiting -= 1
+            self.latency.setdefault(priority, Histogram()).observe(time.perf_counter() - started)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._users.pop(user_id, None)
+
+    def settle(self, est_tokens: int, used_tokens: int | None) -> None:
+        """Return over-estimated tokens to the TPM bucket once usage is known."""
+        if used_tokens is not None and used_tokens < est_tokens:
+            self._tokens.refund(est_tokens - used_tokens)
+
+    async def retrying(self, fn):
+        """Await fn(), retrying 429/5xx/network errors with jittered backoff honouring Retry-After.
+
+        Called inside ``slot``, which paid for the first attempt; every retry
+        is a new request and takes its own RPM token.
+        """
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            if attempt:
+                await self._requests.acquire(1)
+            try:
+                return await fn()
+            except _retryable_errors() as e:
+                if attempt == OPENAI_MAX_RETRIES:
+                    self.failures += 1
+                    raise
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+                self.retries += 1
+                logging.warning("OpenAI %s, retry %d in %.1fs", type(e).__name__, attempt + 1, delay)
+                await asyncio.sleep(delay)
+
+    async def call(self, fn, est_tokens: int):
+        async with self.slot(est_tokens):
+            return await self.retrying(fn)
+
+
+def estimate_tokens(messages: list[dict], max_tokens: int = OPENAI_MAX_TOKENS) -> int:
+    """Rough prompt+completion estimate (~4 chars/token) for TPM shaping."""
+    return sum(len(str(m.get("content", ""))) for m in messages) // 4 + max_tokens
+
+
+openai_gate = OpenAIGate(OPENAI_MAX_CONCURRENCY, OPENAI_PER_USER_CONCURRENCY, OPENAI_RPM, OPENAI_TPM)
+
+
+# Identiškos vienu metu vykdomos užklausos dalijasi vienu OpenAI kvietimu
+_inflight: dict[str, asyncio.Task] = {}
+
+
+async def single_flight(key: str, factory) -> str:
+    """Run factory() once per key; concurrent callers await the same task."""
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda _t: _inflight.pop(key, None))
+    # shield: vieno laukiančiojo atšaukimas neatšaukia bendro kvietimo kitiems
+    return await asyncio.shield(task)
+
+
+def _chat_messages(user_msg: str, lang_code: str, context_messages: list[dict] | None = None) -> list[dict[str, str]]:
+    # Stabili pradžia (sistema → santrauka → senesnės replikos) leidžia OpenAI kešuoti prompt prefiksą
+    return [
+        {"role": "system", "content": f"{lang_prompt(lang_code)} {SYSTEM_PROMPT}"},
+        *(context_messages or []),
+        {"role": "user", "content": user_msg},
+    ]
+
+
+async def _complete(
+    user_msg: str, lang_code: str, context_messages: list[dict] | None = None, max_tokens: int = OPENAI_MAX_TOKENS
+) -> str:
+    messages = _chat_messages(user_msg, lang_code, context_messages)
+    est = estimate_tokens(messages, max_tokens)
+    resp = await openai_gate.call(
+        lambda: openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            temperature=OPENAI_TEMPERATURE,
+            max_tokens=max_tokens,
+        ),
+        est,
+    )
+    openai_gate.settle(est, getattr(resp.usage, "total_tokens", None))
+    record_usage(resp.usage)
+    return resp.choices[0].message.content
+
+
+def _request_key(user_msg: str, lang_code: str, context_messages: list[dict] | None) -> str:
+    if context_messages:
+        user_msg = json.dumps(context_messages, ensure_ascii=False) + user_msg
+    return ResponseCache.make_key(user_msg, lang_code, OPENAI_MODEL, OPENAI_TEMPERATURE)
+
+
+@instrumented()
+async def ask_openai(
+    user_msg: str, lang_code: str, feature: str = "", context_messages: list[dict] | None = None
+) -> str:
+    """Ask the model; replies for features listed in CACHE_TTL are served from cache."""
+    ttl = CACHE_TTL.get(feature, 0)
+    key = _request_key(user_msg, lang_code, context_messages)
+    if ttl:
+        cached = await response_cache.get(key)
+        if cached is not None:
+            return cached
+    try:
+        reply = await single_flight(key, lambda: _complete(user_msg, lang_code, context_messages))
     except Exception as e:
         logging.error("OpenAI request failed: %s", e)
+        await refund_usage()
         return "⚠️ Nepavyko gauti atsakymo iš modelio."
-async def generate_quiz(topic: str, context: ContextTypes.DEFAULT_TYPE) -> str:
-    level = context.user_data.get("profile", {}).get("level", "studentas")
-    lang = context.user_data.get("profile", {}).get("language", detect_language(topic))
+    if ttl and reply:
+        await response_cache.set(key, reply, ttl)
+    return reply
+# ─────────────────────────── Streaming ─────────────────────────────
+class StreamingReply:
+    """Progressively edits one Telegram message; rolls over past the 4096-char limit.
+
+    The model stream only ``feed``s deltas; ``run`` applies them as throttled
+    edits in its own task, so Telegram flood control never holds an OpenAI slot.
+    """
+
+    def __init__(self, message, header: str = ""):
+        self._message = message
+        self._sent = None
+        self._header = header
+        self._text = header
+        self._shown = ""
+        self._next_edit = 0.0
+        self._pending: list[str] = []
+        self._wake = asyncio.Event()
+        self._closed = False
+
+    def feed(self, delta: str) -> None:
+        self._pending.append(delta)
+        self._wake.set()
+
+    def close(self) -> None:
+        """No more deltas: run() shows the rest and returns."""
+        self._closed = True
+        self._wake.set()
+
+    async def run(self) -> None:
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            if self._pending:
+                delta = "".join(self._pending)
+                self._pending.clear()
+                await self.push(delta)
+            if self._closed and not self._pending:
+                if self._text != self._header:  # be deltų – nieko nerodome
+                    await self.finish()
+                return
+
+    async def push(self, delta: str) -> None:
+        self._text += delta
+        while len(self._text) > TELEGRAM_MESSAGE_LIMIT:
+            cut = self._text.rfind("\n", 0, TELEGRAM_MESSAGE_LIMIT)
+            if cut <= 0:
+                cut = TELEGRAM_MESSAGE_LIMIT
+            head, self._text = self._text[:cut], self._text[cut:].lstrip("\n")
+            await self._show(head, wait=True)
+            self._sent, self._shown = None, ""
+        if time.monotonic() >= self._next_edit:
+            await self._show(self._text)
+
+    async def finish(self) -> None:
+        await self._show(self._text, wait=True)
+
+    async def _show(self, text: str, wait: bool = False) -> None:
+        if not text.strip() or text == self._shown:
+            return
+        if wait:
+            await asyncio.sleep(max(0.0, self._next_edit - time.monotonic()))
+        try:
+            if self._sent is None:
+                self._sent = await self._message.reply_text(text)
+            else:
+                await self._sent.edit_text(text)
+        except Exception as e:
+            # RetryAfter: Telegram nurodo, kiek laukti iki kito redagavimo
+            delay = getattr(e, "retry_after", None)
+            if isinstance(delay, dt.timedelta):
+                delay = delay.total_seconds()
+            self._next_edit = time.monotonic() + (delay or STREAM_EDIT_INTERVAL)
+            logging.warning("Stream edit failed: %s", e)
+            if wait and delay:
+                await self._show(text, wait=True)
+            return
+        self._shown = text
+        self._next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+
+
+async def reply_streamed(
+    message, user_msg: str, lang_code: str, feature: str = "", header: str = "",
+    context_messages: list[dict] | None = None,
+) -> str:
+    """Send the model reply to message, streaming it by edits when STREAM_REPLIES is on."""
+    if not STREAM_REPLIES:
+        reply = await ask_openai(user_msg, lang_code, feature, context_messages)
+        await message.reply_text(header + reply)
+        return reply
+    ttl = CACHE_TTL.get(feature, 0)
+    key = _request_key(user_msg, lang_code, context_messages)
+    if ttl:
+        cached = await response_cache.get(key)
+        if cached is not None:
+            await message.reply_text(header + cached)
+            return cached
+    out = StreamingReply(message, header)
+    editor = asyncio.create_task(out.run())  # Telegram redagavimai – už OpenAI vietos ribų
+    parts: list[str] = []
+    complete = False
+    messages = _chat_messages(user_msg, lang_code, context_messages)
+    est = estimate_tokens(messages)
+    try:
+        async with openai_gate.slot(est):
+            stream = await openai_gate.retrying(
+                lambda: openai_client().chat.completions.create(
+                    model=OPENAI_MODEL,
+                    messages=messages,
+                    temperature=OPENAI_TEMPERATURE,
+                    max_tokens=OPENAI_MAX_TOKENS,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+            )
+            async for chunk in stream:
+                if chunk.usage is not None:  # paskutinis fragmentas
+                    openai_gate.settle(est, chunk.usage.total_tokens)
+                    record_usage(chunk.usage)
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    out.feed(delta)
+        complete = True
+    except Exception as e:
+        logging.error("OpenAI stream failed: %s", e)
+    finally:
+        out.close()
+    await editor
+    reply = "".join(parts)
+    if not reply:
+        await refund_usage()
+        reply = "⚠️ Nepavyko gauti atsakymo iš modelio."
+        await message.reply_text(reply)
+        return reply
+    if ttl and complete:
+        await response_cache.set(key, reply, ttl)
+    return reply
+# ──────────────────────── Conversation context ─────────────────────
+# Vykdomos santraukos (po vieną naudotojui); nuoroda laikoma, kol užduotis baigsis
+_summarizing: dict[int, asyncio.Task] = {}
+
+
+@functools.lru_cache(maxsize=1)
+def _token_encoder():
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(OPENAI_MODEL)
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoder = _token_encoder()
+    return len(encoder.encode(text)) if encoder else len(text) // 4 + 1
+
+
+def _chat_turns(user_id: int, since: float = 0) -> list[dict[str, str]]:
+    """Free-chat turns of the user's private chat (private chat id == user id) after `since`."""
+    return [
+        h for h in user_history.get(user_id, [])
+        if h.get("f", "message") == "message" and h.get("c", user_id) == user_id and h.get("t", 0) > since
+    ]
+
+
+def conversation_context(user_id: int) -> tuple[list[dict[str, str]], list[dict[str, str]]]:
+    """Return (context messages, turns that fell out of the window and are not summarized yet).
+
+    The newest free-chat turns are kept while they fit CONTEXT_TOKEN_BUDGET;
+    everything older is represented by the running summary. Turns before
+    /resetcontext are never used again.
+    """
+    summary = conversation_summaries.get(user_id, {})
+    turns = _chat_turns(user_id, summary.get("reset", 0))
+    used, start = 0, len(turns)
+    while start > 0:
+        turn = turns[start - 1]
+        cost = turn.get("n") or (count_tokens(turn["q"]) + count_tokens(turn["a"]))
+        if used + cost > CONTEXT_TOKEN_BUDGET:
+            break
+        used += cost
+        start -= 1
+    messages: list[dict[str, str]] = []
+    if summary.get("text"):
+        messages.append({"role": "system", "content": f"Ankstesnio pokalbio santrauka: {summary['text']}"})
+    for turn in turns[start:]:
+        messages.append({"role": "user", "content": turn["q"]})
+        messages.append({"role": "assistant", "content": turn["a"]})
+    pending = [t for t in turns[:start] if t.get("t", 0) > summary.get("until", 0)]
+    return messages, pending
+
+
+async def _summarize(user_id: int, lang_code: str, pending: list[dict[str, str]]) -> None:
+    reset = conversation_summaries.get(user_id, {}).get("reset", 0)
+    old = conversation_summaries.get(user_id, {}).get("text", "")
+    dialogue = "\n".join(f"Q: {t['q']}\nA: {t['a']}" for t in pending)
     prompt = (
-        f"Sukurk 3 pasirenkamo atsakymo klausimus ({level} lygiui) apie: {topic}. "
-        "Formatuok su pažymėtais atsakymais A), B), C). Prie teisingo atsakymo pridėk ✅."
+        f"Esama santrauka: {old or '(nėra)'}\n\nNaujos replikos:\n{dialogue}\n\n"
+        "Atnaujink santrauką iki 120 žodžių: palik paciento duomenis, tyrimų reikšmes ir neatsakytus klausimus."
+    )
+    try:
+        text = await _complete(prompt, lang_code, max_tokens=CONTEXT_SUMMARY_TOKENS)
+        # per tą laiką /resetcontext – santrauka apimtų ištrintą pokalbį
+        if conversation_summaries.get(user_id, {}).get("reset", 0) == reset:
+            conversation_summaries[user_id] = {"text": text, "until": pending[-1].get("t", time.time()), "reset": reset}
+    except Exception as e:
+        logging.warning("Context summary for %s failed: %s", user_id, e)
+    finally:
+        _summarizing.pop(user_id, None)
+
+
+def maybe_summarize(user_id: int, lang_code: str) -> None:
+    """Fold turns that left the window into the summary, in the background and once per user."""
+    if user_id in _summarizing:
+        return
+    _, pending = conversation_context(user_id)
+    if len(pending) >= CONTEXT_SUMMARY_BATCH:
+        _summarizing[user_id] = asyncio.create_task(_summarize(user_id, lang_code, pending))
+
+
+# ───────────────────────── Content library ─────────────────────────
+# Pasikeitus prompt šablonams, keičiasi versija ir seni paruošti rinkiniai nebenaudojami
+CONTENT_VERSION = hashlib.sha1((QUIZ_PROMPT + FLASHCARDS_PROMPT).encode()).hexdigest()[:8]
+
+
+def normalize_topic(topic: str) -> str:
+    return " ".join(topic.lower().split()).strip(" ,.-:?!")
+
+
+async def content_meta(context: ContextTypes.DEFAULT_TYPE, topic: str) -> dict[str, str]:
+    """Library/analytics key parts for a quiz or flashcard request."""
+    return {
+        "topic": normalize_topic(topic),
+        "lang": await user_language(context, topic),
+        "level": context.user_data.get("profile", {}).get("level", "studentas"),
+    }
+
+
+class ContentLibrary:
+    """Pre-generated quiz/flashcard sets keyed by (kind, topic, lang, level); current version kept in RAM."""
+
+    def __init__(self, path: str, version: str):
+        self.path = path
+        self.version = version
+        self._items: dict[tuple[str, str, str, str], str] = {}
+        self._db: sqlite3.Connection | None = None
+
+    def _open(self) -> list[tuple]:
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS content (kind TEXT, topic TEXT, lang TEXT, level TEXT, version TEXT, "
+            "body TEXT, created REAL, PRIMARY KEY (kind, topic, lang, level, version))"
+        )
+        self._db.commit()
+        return self._select()
+
+    def _select(self) -> list[tuple]:
+        return self._db.execute(
+            "SELECT kind, topic, lang, level, body FROM content WHERE version = ?", (self.version,)
+        ).fetchall()
+
+    def _insert(self, row: tuple) -> None:
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO content VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+
+    async def open(self) -> None:
+        for kind, topic, lang, level, body in await run_blocking(self._open):
+            self._items[(kind, topic, lang, level)] = body
+
+    async def reload(self) -> None:
+        """Pick up sets another process added since open()."""
+        for kind, topic, lang, level, body in await run_blocking(self._select):
+            self._items[(kind, topic, lang, level)] = body
+
+    @staticmethod
+    def _key(kind: str, topic: str, lang: str, level: str) -> tuple[str, str, str, str]:
+        return kind, topic, lang, level if kind == "quiz" else ""  # kortelės nepriklauso nuo lygio
+
+    def get(self, kind: str, topic: str, lang: str, level: str) -> str | None:
+        return self._items.get(self._key(kind, topic, lang, level))
+
+    async def put(self, kind: str, topic: str, lang: str, level: str, body: str) -> None:
+        key = self._key(kind, topic, lang, level)
+        self._items[key] = body
+        if self._db is not None:
+            await run_blocking(self._insert, (*key, self.version, body, time.time()))
+
+
+content_library = ContentLibrary(CONTENT_LIBRARY_PATH, CONTENT_VERSION)
+
+
+def mine_popular_topics(log_paths: list[str], days: int, top_n: int) -> list[tuple[tuple[str, str, str, str], int]]:
+    """Count quiz/flashcard requests per (kind, topic, lang, level) in the raw analytics files of every worker."""
+    cutoff = time.time() - days * 86400
+    counts: Counter = Counter()
+    rotated = [f"{p}.{i}" for p in log_paths for i in range(1, ANALYTICS_LOG_BACKUPS + 1)]
+    for path in log_paths + rotated:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                kind = event.get("feature")
+                if kind in ("quiz", "flashcards") and event.get("topic") and event.get("time", 0) >= cutoff:
+                    level = event.get("level", "") if kind == "quiz" else ""
+                    counts[(kind, event["topic"], event.get("lang", "en"), level)] += 1
+    return counts.most_common(top_n)
+
+
+async def precompute_popular() -> int:
+    """Generate missing sets for the most requested topics; runs at background (lowest) priority."""
+    popular = await run_blocking(
+        mine_popular_topics,
+        [worker_file(ANALYTICS_LOG_PATH, i) for i in range(WEBHOOK_WORKERS)],
+        PRECOMPUTE_LOOKBACK_DAYS,
+        PRECOMPUTE_TOP_N,
     )
-    questions = await ask_openai(prompt, lang)
-    context.user_data["last_quiz"] = {"topic": topic, "content": questions}
-    context.user_data["last_reply"] = questions
+    made = 0
+    for (kind, topic, lang, level), count in popular:
+        if count < PRECOMPUTE_MIN_COUNT or content_library.get(kind, topic, lang, level):
+            continue
+        if kind == "quiz":
+            prompt = QUIZ_PROMPT.format(topic=topic, level=level or "studentas")
+        else:
+            prompt = FLASHCARDS_PROMPT.format(topic=topic)
+        try:
+            body = await _complete(prompt, lang)
+        except Exception as e:
+            logging.warning("Precompute %s/%s failed: %s", kind, topic, e)
+            continue
+        if kind == "quiz" and parse_quiz(body) is None:
+            logging.warning("Precompute quiz/%s: model did not return valid JSON", topic)
+            continue
+        if body:
+            await content_library.put(kind, topic, lang, level, body)
+            made += 1
+    logging.info("Precomputed %d content sets (version %s)", made, content_library.version)
+    return made
+
+
+async def _precompute_loop() -> None:
+    await asyncio.sleep(60)  # neapkrauname paleidimo
+    while True:
+        try:
+            if WORKER_INDEX == 0:
+                await precompute_popular()
+            else:
+                await content_library.reload()  # generuoja darbininkas 0, kiti tik perskaito
+        except Exception as e:
+            logging.error("Precompute failed: %s", e)
+        await asyncio.sleep(PRECOMPUTE_INTERVAL)
+
+
+def parse_quiz(text: str) -> list[dict] | None:
+    """Parse the model's JSON quiz into compact {"q", "o", "a", "e"} items; None if it is not valid."""
+    start, end = text.find("{"), text.rfind("}")
+    try:
+        data = json.loads(text[start:end + 1])
+        questions = [
+            {"q": str(q["q"]), "o": [str(o) for o in q["options"]], "a": int(q["answer"]), "e": str(q.get("explanation", ""))}
+            for q in data["questions"]
+        ]
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not questions or any(not 2 <= len(q["o"]) <= len(QUIZ_LETTERS) or not 0 <= q["a"] < len(q["o"]) for q in questions):
+        return None
     return questions
+
+
+def format_quiz(questions: list[dict]) -> str:
+    """Render a parsed quiz for the chat (without revealing the answers)."""
+    blocks = []
+    for n, q in enumerate(questions, 1):
+        options = "\n".join(f"{QUIZ_LETTERS[i]}) {o}" for i, o in enumerate(q["o"]))
+        blocks.append(f"{n}. {q['q']}\n{options}")
+    return "\n\n".join(blocks) + "\n\n✏️ Atsakyk su /answer"
+
+
+def grade_quiz(questions: list[dict], picks: list[int]) -> tuple[int, str, list[dict]]:
+    """Grade locally; returns (score, feedback text, missed questions with the user's pick)."""
+    lines, missed = [], []
+    for n, (q, pick) in enumerate(zip(questions, picks), 1):
+        correct = QUIZ_LETTERS[q["a"]]
+        if pick == q["a"]:
+            lines.append(f"{n}. ✅ {correct}")
+            continue
+        missed.append({**q, "pick": pick})
+        line = f"{n}. ❌ {QUIZ_LETTERS[pick]} → teisingas {correct}) {q['o'][q['a']]}"
+        lines.append(f"{line}\n   {q['e']}" if q["e"] else line)
+    return len(questions) - len(missed), "\n".join(lines), missed
+
+
+async def generate_quiz(topic: str, context: ContextTypes.DEFAULT_TYPE) -> str:
+    meta = await content_meta(context, topic)
+    raw = content_library.get("quiz", **meta)
+    if raw is None:
+        prompt = QUIZ_PROMPT.format(topic=topic, level=meta["level"])
+        raw = await ask_openai(prompt, meta["lang"], "quiz")
+    questions = parse_quiz(raw)
+    # Jei modelis negrąžino JSON, paliekame tekstą ir vertinimą per modelį
+    content = format_quiz(questions) if questions else raw
+    context.user_data["last_quiz"] = {"topic": topic, "content": content, "questions": questions}
+    context.user_data["last_reply"] = content
+    return content
 async def generate_flashcards(topic: str, context: ContextTypes.DEFAULT_TYPE) -> str:
-    lang = context.user_data.get("profile", {}).get("language", detect_language(topic))
-    prompt = f"Sukurk 5 flashcards tema: {topic}, klausimas ir trumpas atsakymas."
-    cards = await ask_openai(prompt, lang)
+    meta = await content_meta(context, topic)
+    cards = content_library.get("flashcards", **meta)
+    if cards is None:
+        cards = await ask_openai(FLASHCARDS_PROMPT.format(topic=topic), meta["lang"], "flashcards")
     context.user_data["last_reply"] = cards
     return cards
-async def generate_notes(topic: str, context: ContextTypes.DEFAULT_TYPE) -> str:
-    lang = context.user_data.get("profile", {}).get("language", detect_language(topic))
+async def generate_notes(topic: str, context: ContextTypes.DEFAULT_TYPE, message=None) -> str:
+    """Generate notes; when message is given the reply is delivered (streamed) to it."""
+    lang = await user_language(context, topic)
     prompt = (
         f"Sukurk glaustą, aiškų medicininį konspektą studentui apie {topic}, "
         "naudodamasis PubMed, Cochrane ir UpToDate duomenimis. Struktūruok punktuose."
     )
-    notes = await ask_openai(prompt, lang)
+    if message is not None:
+        notes = await reply_streamed(message, prompt, lang, "notes")
+    else:
+        notes = await ask_openai(prompt, lang, "notes")
     context.user_data["last_reply"] = notes
     return notes
 async def analyze_literature(reference: str, context: ContextTypes.DEFAULT_TYPE) -> str:
-    lang = context.user_data.get("profile", {}).get("language", detect_language(reference))
+    lang = await user_language(context, reference)
     prompt = (
         f"Remiantis straipsniu (DOI arba pavadinimu: {reference}), "
         "pateik mokslinę santrauką, klinikinę reikšmę ir kontekstą. Naudok tik recenzuotus šaltinius."
     )
-    summary = await ask_openai(prompt, lang)
+    summary = await ask_openai(prompt, lang, "literature")
     context.user_data["last_reply"] = summary
     return summary
 # ──────────────────── PsycheCare functions ─────────────────────
@@ -250,17 +2568,21 @@ async def mood_stress(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def mood_worry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     entry = context.user_data.pop("mood_entry", {})
     entry["worry"] = update.message.text.strip()
+    series = mood_series(update.effective_user.id)
     mood_logs.setdefault(update.effective_user.id, []).append(entry)
+    with contextlib.suppress(ValueError):
+        series.append(time.time(), float(entry.get("rating", "").replace(",", ".")))
+        mood_ratings.touch(update.effective_user.id)
     prompt = (
         f"Vartotojo nuotaika {entry.get('rating')}, stresas {entry.get('stress')}, neramina: {entry.get('worry')}. "
         "Pasiūlyk trumpą palaikymą ir kvėpavimo pratimą."
     )
-    lang = context.user_data.get("profile", {}).get("language", detect_language(entry.get("worry", "")))
+    lang = await user_language(context, entry.get("worry", ""))
     support = await ask_openai(prompt, lang)
     context.user_data["last_reply"] = support
     await update.message.reply_text(support)
     log_interaction(update.effective_user.id, json.dumps(entry, ensure_ascii=False), support, "mood")
-    return ConversationHandler.END
+    return END
 async def reflect(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Kas šiandien pavyko?")
     return REFLECT_Q1
@@ -279,7 +2601,7 @@ async def reflect_q3(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["last_reply"] = "Užrašyta."
     await update.message.reply_text("Užrašyta.")
     log_interaction(update.effective_user.id, json.dumps(entry, ensure_ascii=False), "saved", "reflect")
-    return ConversationHandler.END
+    return END
 async def calm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [["Kvėpavimas"], ["Meditacija"], ["Vizualizacija"], ["Afirmacijos"]]
     await update.message.reply_text(
@@ -299,7 +2621,7 @@ async def calm_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(msg, reply_markup=ReplyKeyboardRemove())
     context.user_data["last_reply"] = msg
     log_interaction(update.effective_user.id, choice, msg, "calm")
-    return ConversationHandler.END
+    return END
 async def daily_plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Įrašyk 3 svarbiausius dienos tikslus, atskirk kableliais:")
     return DAILY_GOALS
@@ -312,20 +2634,20 @@ async def receive_goals(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["last_reply"] = txt
     await update.message.reply_text("✅ Tikslai išsaugoti.")
     log_interaction(update.effective_user.id, "goals", txt, "daily_plan")
-    return ConversationHandler.END
+    return END
+def trend_label(slope: float | None, tolerance: float) -> str:
+    if slope is None or abs(slope) < tolerance:
+        return "stabilu"
+    return "pagerėjimas" if slope > 0 else "blogėjimas"
 async def mood_progress_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logs = mood_logs.get(update.effective_user.id, [])
-    if not logs:
+    week = mood_series(update.effective_user.id).since_days(7)
+    if not week:
         return await update.message.reply_text("Nėra duomenų.")
-    week_ago = dt.date.today() - dt.timedelta(days=7)
-    vals = [int(e.get("rating", 0)) for e in logs if dt.date.fromisoformat(e["date"]) >= week_ago]
-    if not vals:
-        return await update.message.reply_text("Nėra duomenų.")
-    trend = "pagerėjimas" if vals[-1] > vals[0] else "blogėjimas" if vals[-1] < vals[0] else "stabilu"
-    msg = f"Vidutinis nuotaikos balas: {sum(vals)/len(vals):.1f} ({trend})"
+    trend = trend_label(week.slope_per_day(), 0.05)
+    msg = f"Vidutinis nuotaikos balas: {week.mean():.1f} ({trend})"
     context.user_data["last_reply"] = msg
     await update.message.reply_text(msg)
-    return ConversationHandler.END
+    return END
 async def panic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = (
         "Giliai įkvėpk, sulaikyk 4 s, iškvėpk 6 s. Jei reikalinga skubi pagalba, skambink 112. "
@@ -348,66 +2670,85 @@ async def update_metric_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = parse_metrics(text)
     if not data:
         return await update.message.reply_text("Nepavyko suprasti duomenų.")
-    data["date"] = dt.datetime.now().isoformat()
-    metrics = health_metrics.setdefault(update.effective_user.id, [])
-    metrics.append(data)
+    now = time.time()
+    series = metric_series(update.effective_user.id)
+    for key, value in data.items():
+        series.setdefault(key, TimeSeries()).append(now, value)
+    health_metrics.touch(update.effective_user.id)
     await update.message.reply_text("✅ Duomenys išsaugoti.")
+METRIC_LABELS = {
+    "svoris": ("Svoris", "kg"),
+    "kmi": ("KMI", ""),
+    "sistolinis": ("Sistolinis AKS", "mmHg"),
+    "diastolinis": ("Diastolinis AKS", "mmHg"),
+    "gliukozė": ("Gliukozė", "mmol/l"),
+    "pulsas": ("Pulsas", "k./min"),
+    "cholesterolis": ("Cholesterolis", "mmol/l"),
+}
 async def metrics_progress_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    metrics = health_metrics.get(update.effective_user.id)
-    if not metrics or len(metrics) < 2:
-        return await update.message.reply_text("Nėra pakankamai duomenų.")
-    first, last = metrics[0], metrics[-1]
+    series = metric_series(update.effective_user.id)
     changes = []
-    if "kmi" in first and "kmi" in last:
-        diff = last["kmi"] - first["kmi"]
-        changes.append(f"KMI pokytis: {diff:+.1f}")
-    if "svoris" in first and "svoris" in last:
-        diff = last["svoris"] - first["svoris"]
-        changes.append(f"Svorio pokytis: {diff:+.1f} kg")
+    for key, (label, unit) in METRIC_LABELS.items():
+        s = series.get(key)
+        if s is None or len(s) < 2:
+            continue
+        line = f"{label}: {s.values[-1]:g} {unit} (pokytis {s.values[-1] - s.values[0]:+.1f})".replace("  ", " ")
+        if len(s) >= 7:
+            line += f"; 7 įrašų slenk. vid. {s.rolling_mean(7)[-1]:.1f}"
+        month = s.since_days(30)
+        if len(month) >= 2:
+            lo, hi = month.min_max()
+            line += f"; 30 d. vid. {month.mean():.1f}, min–max {lo:g}–{hi:g}"
+        slope = s.since_days(90).slope_per_day()
+        if slope is not None:
+            line += f"; tendencija {slope * 7:+.2f}/sav."
+        changes.append(line)
     msg = "\n".join(changes) or "Nėra pakankamai duomenų."
     await update.message.reply_text(msg)
-async def _reminder_once(bot, chat_id: int, delay: float, text: str):
-    await asyncio.sleep(delay)
-    await bot.send_message(chat_id, text)
-async def _reminder_loop(bot, chat_id: int, delay: float, interval: float, text: str):
-    await asyncio.sleep(delay)
-    while True:
-        await bot.send_message(chat_id, text)
-        await asyncio.sleep(interval)
 async def set_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    action = context.args[0].lower() if context.args else ""
+    if action == "list":
+        items = reminder_scheduler.list_for(uid)
+        if not items:
+            return await update.message.reply_text("Nėra priminimų.")
+        modes = {v: k for k, v in REMINDER_INTERVALS.items()}
+        lines = [
+            " ".join(filter(None, [
+                f"#{rid}", f"{dt.datetime.fromtimestamp(r['due']):%Y-%m-%d %H:%M}", modes.get(r["interval"]), r["text"],
+            ]))
+            for rid, r in items
+        ]
+        return await update.message.reply_text("\n".join(lines))
+    if action == "cancel":
+        if len(context.args) < 2 or not context.args[1].lstrip("#").isdigit():
+            return await update.message.reply_text("Naudok: /remind cancel <id>")
+        if reminder_scheduler.cancel(uid, int(context.args[1].lstrip("#"))):
+            return await update.message.reply_text("🗑️ Priminimas atšauktas.")
+        return await update.message.reply_text("❗ Nėra tokio priminimo.")
     if len(context.args) < 2:
         return await update.message.reply_text(
-            "Naudok: /remind <daily|weekly|YYYY-MM-DD> tekstas"
+            "Naudok: /remind <daily|weekly|YYYY-MM-DD> tekstas, /remind list, /remind cancel <id>"
         )
-    mode = context.args[0].lower()
     text = " ".join(context.args[1:])
-    if mode == "daily":
-        task = context.application.create_task(
-            _reminder_loop(context.bot, update.effective_chat.id, 0, 86400, text)
-        )
-    elif mode == "weekly":
-        task = context.application.create_task(
-            _reminder_loop(context.bot, update.effective_chat.id, 0, 604800, text)
-        )
+    if action in REMINDER_INTERVALS:
+        due, interval = time.time(), REMINDER_INTERVALS[action]
     else:
         try:
-            target = dt.datetime.strptime(mode, "%Y-%m-%d")
+            target = dt.datetime.strptime(action, "%Y-%m-%d")
         except ValueError:
             return await update.message.reply_text("Data turi būti YYYY-MM-DD.")
-        delay = (target - dt.datetime.now()).total_seconds()
-        if delay <= 0:
+        due, interval = target.timestamp(), 0
+        if due <= time.time():
             return await update.message.reply_text("Data turi būti ateityje.")
-        task = context.application.create_task(
-            _reminder_once(context.bot, update.effective_chat.id, delay, text)
-        )
-    reminder_tasks.setdefault(update.effective_user.id, []).append(task)
-    await update.message.reply_text("✅ Priminimas nustatytas.")
+    rid = reminder_scheduler.add(uid, update.effective_chat.id, text, due, interval)
+    await update.message.reply_text(f"✅ Priminimas nustatytas (#{rid}).")
 # ──────────────────────────── Commands ─────────────────────────────
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("👋 Sveikas! Aš – *Medic Assistant*.", parse_mode="Markdown")
     await update.message.reply_text(
         "Komandos:\n"
-        "/start, /profile, /quiz, /answer, /review, /export_pdf, /export_test, "
+        "/start, /profile, /quiz, /answer, /explain, /review, /export_pdf, /export_test, "
         "/export_history, /flashcards, /method, /guideline, /simpatient, /progress, /progress_pdf, "
         "/subscription_status, /upgrade, /create_room, /join_room, /list_rooms, /resetcontext, "
         "/update_metric, /metrics_progress, /remind, /mood, /reflect, /calm, /daily_plan, /mood_progress, /panic, /mode"
@@ -448,13 +2789,15 @@ async def set_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["profile"]["level"] = update.message.text.lower()
     await update.message.reply_text(f"✅ Profilis nustatytas: {context.user_data['profile']}",
                                     reply_markup=ReplyKeyboardRemove())
-    return ConversationHandler.END
+    return END
 async def resetcontext(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
+    # santrauka ištrinama; ankstesnės replikos lieka istorijoje, bet į kontekstą nebepatenka
+    conversation_summaries[update.effective_user.id] = {"reset": time.time()}
     await update.message.reply_text("♻️ Kontekstas išvalytas!")
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Nutraukta.", reply_markup=ReplyKeyboardRemove())
-    return ConversationHandler.END
+    return END
 # Method info
 async def method(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("📖 Įrašyk medicininį metodą, kurį nori suprasti.")
@@ -463,40 +2806,71 @@ async def quiz(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🧪 Įrašyk testavimo temą:")
     return QUIZ_TOPIC
 async def receive_quiz_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not increment_usage(update.effective_user.id):
+    if not await increment_usage(update.effective_user.id):
         return await quota_exceeded(update, context)
     topic = update.message.text.strip()
-    level = context.user_data.get("profile", {}).get("level", "studentas")
-    prompt = (
-        f"Sukurk 3 pasirenkamo atsakymo klausimus ({level} lygiui) apie: {topic}. "
-        "Formatuok su pažymėtais atsakymais A), B), C). Prie teisingo atsakymo pridėk ✅."
-    )
-    lang = context.user_data.get("profile", {}).get("language", detect_language(topic))
-    questions = await ask_openai(prompt, lang)
-    context.user_data["last_quiz"] = {"topic": topic, "content": questions}
-    context.user_data["last_reply"] = questions
+    questions = await generate_quiz(topic, context)
     user_progress[update.effective_user.id] = user_progress.get(update.effective_user.id, 0) + 1
     await update.message.reply_text(f"🧠 Klausimai apie '{topic}':\n\n{questions}")
-    log_interaction(update.effective_user.id, topic, questions, "quiz")
-    return ConversationHandler.END
+    log_interaction(update.effective_user.id, topic, questions, "quiz", **await content_meta(context, topic))
+    return END
 async def answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if "last_quiz" not in context.user_data:
         await update.message.reply_text("❗ Su /quiz sukurk testą.")
-        return ConversationHandler.END
+        return END
     await update.message.reply_text("✏️ Įvesk savo atsakymus A/B/C, pvz.: A B C")
     return ANSWER_STATE
+def parse_picks(text: str, count: int) -> list[int] | None:
+    """'A B C', 'abc', '1A 2B 3C' → option indexes; None if the count or letters do not match."""
+    letters = re.sub(r"[\s,;.:)\d-]", "", text.upper())
+    if len(letters) != count or any(ch not in QUIZ_LETTERS for ch in letters):
+        return None
+    return [QUIZ_LETTERS.index(ch) for ch in letters]
 async def receive_answers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not increment_usage(update.effective_user.id):
-        return await quota_exceeded(update, context)
     ans = update.message.text.strip()
-    quiz = context.user_data["last_quiz"]["content"]
+    last = context.user_data["last_quiz"]
+    questions = last.get("questions")
+    if questions:
+        picks = parse_picks(ans, len(questions))
+        if picks is None or any(p >= len(q["o"]) for p, q in zip(picks, questions)):
+            await update.message.reply_text(f"✏️ Įvesk {len(questions)} atsakymus raidėmis, pvz.: A B C")
+            return ANSWER_STATE
+        score, feedback, missed = grade_quiz(questions, picks)
+        last["missed"] = missed
+        result = f"{score}/{len(questions)}\n{feedback}"
+        if missed:
+            result += "\n\n💡 Išsamesniam klaidų paaiškinimui – /explain"
+        context.user_data["last_reply"] = result
+        await update.message.reply_text(f"📝 Vertinimas: {result}")
+        log_interaction(update.effective_user.id, ans, result, "answer")
+        return END
+    if not await increment_usage(update.effective_user.id):
+        return await quota_exceeded(update, context)
+    quiz = last["content"]
     prompt = f"Tekstas su ✅ teisingais atsakymais: {quiz} Vartotojo atsakymai: {ans}. Įvertink ir paaiškink."
-    lang = context.user_data.get("profile", {}).get("language", detect_language(ans))
+    lang = await user_language(context, ans)
     result = await ask_openai(prompt, lang)
     context.user_data["last_reply"] = result
     await update.message.reply_text(f"📝 Vertinimas:\n{result}")
     log_interaction(update.effective_user.id, ans, result, "answer")
-    return ConversationHandler.END
+    return END
+async def explain(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    missed = context.user_data.get("last_quiz", {}).get("missed")
+    if not missed:
+        await update.message.reply_text("❗ Nėra klaidų, kurias reikėtų paaiškinti. Atsakyk į testą su /answer.")
+        return
+    if not await increment_usage(update.effective_user.id):
+        return await quota_exceeded(update, context)
+    topic = context.user_data["last_quiz"]["topic"]
+    mistakes = "\n".join(
+        f"- {q['q']} Pasirinkta: {q['o'][q['pick']]}. Teisinga: {q['o'][q['a']]}." for q in missed
+    )
+    prompt = f"Studentas suklydo teste apie {topic}:\n{mistakes}\nPaaiškink, kodėl teisingi atsakymai yra teisingi ir kur slypi klaida."
+    lang = await user_language(context, topic)
+    result = await ask_openai(prompt, lang)
+    context.user_data["last_reply"] = result
+    await update.message.reply_text(f"💡 Paaiškinimas:\n{result}")
+    log_interaction(update.effective_user.id, topic, result, "explain")
 async def review(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if "last_quiz" in context.user_data:
         q = context.user_data["last_quiz"]
@@ -508,11 +2882,7 @@ async def export_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not has_feature(update.effective_user.id, "pdf"):
         return await restricted_feature(update, context, "pdf")
     if "last_reply" in context.user_data:
-        path = save_as_pdf(context.user_data["last_reply"], "reply.pdf")
-        if path:
-            await update.message.reply_document(InputFile(path))
-        else:
-            await update.message.reply_text("❗ Nepavyko sukurti PDF.")
+        await send_pdf(update, "reply.pdf", context.user_data["last_reply"])
     else:
         await update.message.reply_text("❗ Nėra atsakymo.")
 async def export_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -521,35 +2891,55 @@ async def export_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if "last_quiz" in context.user_data:
         q = context.user_data["last_quiz"]
         text = f"Tema: {q['topic']}\n\n{q['content']}"
-        path = save_as_pdf(text, "testas.pdf")
-        if path:
-            await update.message.reply_document(InputFile(path))
-        else:
-            await update.message.reply_text("❗ Nepavyko sukurti PDF.")
+        if q.get("questions"):
+            key = " ".join(f"{n}{QUIZ_LETTERS[item['a']]}" for n, item in enumerate(q["questions"], 1))
+            text += f"\n\nAtsakymai: {key}"
+        await send_pdf(update, "testas.pdf", text)
     else:
         await update.message.reply_text("❗ Nėra testo.")
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+def write_history_export(user_id: int, recent: list[dict[str, str]], fmt: str) -> str:
+    """Write the history page by page to a temp file (json, otherwise txt) and return its path."""
+    fd, path = tempfile.mkstemp(prefix=f"history_{user_id}_", suffix=".json" if fmt == "json" else ".txt")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        if fmt == "json":
+            sep = "[\n  "
+            for page in iter_history(user_id, recent):
+                for h in page:
+                    f.write(sep + json.dumps(h, ensure_ascii=False))
+                    sep = ",\n  "
+            f.write("\n]\n" if sep != "[\n  " else "[]\n")
+        else:
+            for page in iter_history(user_id, recent):
+                f.writelines(f"Q: {h['q']}\nA: {h['a']}\n\n" for h in page)
+    return path
+
+
 async def export_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    hist = user_history.get(update.effective_user.id)
-    if not hist:
+    uid = update.effective_user.id
+    if not await has_history(uid):
         return await update.message.reply_text("❗ Nėra istorijos.")
     fmt = context.args[0].lower() if context.args else "pdf"
-    if fmt == "json":
-        data = json.dumps(hist, ensure_ascii=False, indent=2)
-        path = "/tmp/history.json"
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(data)
-    elif fmt == "txt":
-        text = "\n\n".join(f"Q: {h['q']}\nA: {h['a']}" for h in hist)
-        path = "/tmp/history.txt"
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(text)
-    else:
-        text = "\n\n".join(f"Q: {h['q']}\nA: {h['a']}" for h in hist)
-        path = save_as_pdf(text, "history.pdf")
-    if path:
-        await update.message.reply_document(InputFile(path))
-    else:
-        await update.message.reply_text("❗ Nepavyko sukurti PDF.")
+    _exporting[uid] += 1
+    try:
+        # vykstantis išpylimas turi baigtis, kitaip įrašai dubliuotųsi arba eilutė būtų nebaigta
+        if spill := _spilling.get(uid):
+            await asyncio.wait([spill])
+        path = await run_blocking(write_history_export, uid, list(user_history.get(uid, [])), fmt)
+    finally:
+        _exporting[uid] -= 1
+        if not _exporting[uid]:
+            del _exporting[uid]
+    try:
+        if fmt in ("json", "txt"):
+            data = await run_blocking(_read_bytes, path)
+            await update.message.reply_document(InputFile(data, filename=f"history.{fmt}"))
+        else:
+            await send_pdf(update, "history.pdf", source_path=path)
+    finally:
+        await run_blocking(os.remove, path)
 # Flashcards (tier ≥2)
 async def flashcards(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not has_feature(update.effective_user.id, "flashcards"):
@@ -557,36 +2947,39 @@ async def flashcards(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("📚 Įrašyk temą flashcards:")
     return FLASH_TOPIC
 async def receive_flash_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not increment_usage(update.effective_user.id):
+    if not await increment_usage(update.effective_user.id):
         return await quota_exceeded(update, context)
     top = update.message.text.strip()
-    lang = context.user_data.get("profile", {}).get("language", detect_language(top))
-    prompt = f"Sukurk 5 flashcards tema: {top}, klausimas ir trumpas atsakymas."
-    rc = await ask_openai(prompt, lang)
-    context.user_data["last_reply"] = rc
+    rc = await generate_flashcards(top, context)
     await update.message.reply_text(f"🧠 Flashcards:\n\n{rc}")
-    log_interaction(update.effective_user.id, top, rc, "flashcards")
-    return ConversationHandler.END
+    log_interaction(update.effective_user.id, top, rc, "flashcards", **await content_meta(context, top))
+    return END
 # Simulated patient
 async def simpatient(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🤖 Įrašyk simptomus:")
     return SIM_SYMPTOMS
 async def receive_symptoms(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not increment_usage(update.effective_user.id):
+    if not await increment_usage(update.effective_user.id):
         return await quota_exceeded(update, context)
     sym = update.message.text.strip()
-    lang = context.user_data.get("profile", {}).get("language", detect_language(sym))
+    lang = await user_language(context, sym)
     prompt = f"Remdamasis simptomais: {sym}, sukurk klinikinį atvejį su anamneze, tyrimais, diagnozę."
-    case = await ask_openai(prompt, lang)
+    case = await reply_streamed(update.message, prompt, lang, header="📋 Atvejis:\n\n")
     context.user_data["last_reply"] = case
-    await update.message.reply_text(f"📋 Atvejis:\n\n{case}")
     log_interaction(update.effective_user.id, sym, case, "simpatient")
-    return ConversationHandler.END
+    return END
 # Guidelines feed
 async def guideline(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    feed = feedparser.parse("https://www.ecdc.europa.eu/en/latest-news/rss")
-    items = feed["entries"][:3]
-    msg = "📑 Naujausios ECDC gairės:\n" + "\n".join(f"- {i.title}: {i.link}" for i in items)
+    name = context.args[0].lower() if context.args else next(iter(GUIDELINE_FEEDS), "")
+    if name not in feed_cache.feeds:
+        return await update.message.reply_text("Naudok: /guideline " + "|".join(feed_cache.feeds))
+    if name not in feed_cache.entries:
+        # fonas dar nespėjo atsiųsti – laukiame tik pirmą kartą
+        await feed_cache.refresh(name)
+    items = feed_cache.entries.get(name, [])[:3]
+    if not items:
+        return await update.message.reply_text("❗ Nepavyko gauti gairių.")
+    msg = f"📑 Naujausios {name.upper()} gairės:\n" + "\n".join(f"- {i['title']}: {i['link']}" for i in items)
     await update.message.reply_text(msg)
 # Progress
 async def progress(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -599,19 +2992,45 @@ async def progress_pdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     cnt = user_progress.get(uid, 0)
     txt = f"Naudotojo ID: {uid}\nUžklausos (viso): {cnt}"
-    path = save_as_pdf(txt, "progress.pdf")
-    if path:
-        await update.message.reply_document(InputFile(path))
-    else:
-        await update.message.reply_text("❗ Nepavyko sukurti PDF.")
+    await send_pdf(update, "progress.pdf", txt)
 async def usage_log_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
-    counts: dict[str, int] = {}
-    for rec in analytics_log:
-        counts[rec["user"]] = counts.get(rec["user"], 0) + 1
-    msg = "\n".join(f"{uid}: {cnt}" for uid, cnt in counts.items()) or "No usage"
+    msg = "\n".join(f"{uid}: {cnt}" for uid, cnt in await storage.top("usage_totals", 20)) or "No usage"
+    await storage.refresh("feature_totals")  # kitų darbininkų prieaugis
+    msg += "\n\n" + "\n".join(
+        f"{feature}: {analytics.rollups[feature].total('minute', 60)}/h, "
+        f"{analytics.rollups[feature].total('hour', 24)}/d, {total} viso"
+        for feature, total in sorted(analytics.feature_totals.items(), key=lambda kv: -kv[1])
+        if feature in analytics.rollups
+    )
+    msg += f"\nCache: {response_cache.hits} hits / {response_cache.misses} misses"
+    msg += (
+        f"\nOpenAI: {openai_gate.in_flight} in-flight, {openai_gate.waiting} waiting, "
+        f"{openai_gate.retries} retries, {openai_gate.failures} failed"
+    )
+    msg += "".join(
+        f"\n  {priority_label(p)}: p50 ≤{h.quantile(0.5)}s, p95 ≤{h.quantile(0.95)}s ({h.count})"
+        for p, h in sorted(openai_gate.latency.items(), reverse=True)
+    )
     await update.message.reply_text(msg)
+@metrics.collector
+def runtime_stats():
+    """Existing ad-hoc counters exposed on /metrics."""
+    yield "medic_cache_hits_total", "counter", {}, response_cache.hits
+    yield "medic_cache_misses_total", "counter", {}, response_cache.misses
+    yield "medic_openai_in_flight", "gauge", {}, openai_gate.in_flight
+    yield "medic_openai_waiting", "gauge", {}, openai_gate.waiting
+    yield "medic_openai_retries_total", "counter", {}, openai_gate.retries
+    yield "medic_openai_failures_total", "counter", {}, openai_gate.failures
+    for p, h in openai_gate.latency.items():
+        yield "medic_openai_admitted_seconds", "histogram", {"tier": priority_label(p)}, h
+    yield "medic_pdf_pending", "gauge", {}, pdf_renderer.pending
+    yield "medic_pdf_renders_total", "counter", {}, pdf_renderer.renders
+    yield "medic_pdf_render_seconds_total", "counter", {}, pdf_renderer.render_seconds
+    for name, table in storage.tables.items():
+        yield "medic_storage_keys", "gauge", {"table": name}, len(table)
+        yield "medic_storage_dirty", "gauge", {"table": name}, len(table.dirty)
 # Rooms (tier ≥3)
 async def create_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not has_feature(update.effective_user.id, "rooms"):
@@ -619,40 +3038,64 @@ async def create_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
     room = " ".join(context.args)
     if not room:
         return await update.message.reply_text("❗ Nurodyk kambario pavadinimą.")
-    rooms.setdefault(room, []).append(update.effective_user.id)
+    uid = update.effective_user.id
+    await storage.update("rooms", room, lambda members: (members or []) + [uid])
     await update.message.reply_text(f"✅ Kambarys sukurtas: {room}")
 async def join_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not has_feature(update.effective_user.id, "rooms"):
         return await restricted_feature(update, context, "rooms")
     room = " ".join(context.args)
-    if room in rooms:
-        rooms[room].append(update.effective_user.id)
+    uid = update.effective_user.id
+    # kambarį gali būti sukūręs kitas darbininkas – tikrinama ir keičiama vienoje DB transakcijoje
+    if await storage.update("rooms", room, lambda members: None if members is None else members + [uid]) is not None:
         await update.message.reply_text(f"✅ Prisijungei: {room}")
     else:
         await update.message.reply_text("❗ Nėra kambario")
 async def list_rooms(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not has_feature(update.effective_user.id, "rooms"):
         return await restricted_feature(update, context, "rooms")
+    await storage.refresh("rooms")
     if rooms:
         await update.message.reply_text("📋 Kambariai:\n" + "\n".join(rooms.keys()))
     else:
         await update.message.reply_text("❗ Nėra kambarių")
 # Image analysis (tier ≥3)
+def _sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+def encode_image(data: bytes) -> str:
+    """Downscale/re-encode to JPEG (when Pillow is available) and return base64; CPU-bound."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return base64.b64encode(data).decode()
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = img.convert("RGB")
+            img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        if out.tell() < len(data):
+            data = out.getvalue()
+    except Exception as e:
+        logging.warning("Image downscale failed, sending original: %s", e)
+    return base64.b64encode(data).decode()
 async def image_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not has_feature(update.effective_user.id, "image_analysis"):
         return await restricted_feature(update, context, "image_analysis")
     if not update.message.photo:
         return await update.message.reply_text("❗ Siųsk nuotrauką")
-    file = await update.message.photo[-1].get_file()
-    path = f"/tmp/{file.file_id}.jpg"
-    await file.download_to_drive(path)
-    # OpenAI API can't access local file paths. Send the image as a Base64 data
-    # URL instead.
-    with open(path, "rb") as img:
-        encoded = base64.b64encode(img.read()).decode()
-    analysis = await client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
+    photo = update.message.photo[-1]
+    # Tas pats Telegram failas → tas pats file_unique_id, todėl galime nesiųsti iš naujo
+    result = await response_cache.get(f"image:{photo.file_unique_id}")
+    digest = photo.file_unique_id
+    if result is None:
+        file = await photo.get_file()
+        data = bytes(await file.download_as_bytearray())
+        digest = await run_blocking(_sha256_hex, data)
+        result = await response_cache.get(f"image:{digest}")
+    if result is None:
+        encoded = await run_blocking(encode_image, data)
+        messages = [
             {"role": "system", "content": "Analizuok medicininę nuotrauką."},
             {
                 "role": "user",
@@ -660,22 +3103,34 @@ async def image_analysis(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     {"type": "text", "text": "Prašau išanalizuoti nuotrauką."},
                     {
                         "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{encoded}"
-                        },
+                        "image_url": {"url": f"data:image/jpeg;base64,{encoded}", "detail": IMAGE_DETAIL},
                     },
                 ],
             },
-        ],
-    )
-    result = analysis.choices[0].message.content
+        ]
+        try:
+            est = OPENAI_MAX_TOKENS + 1000  # ~1000 žetonų paveikslui + atsakymas
+            analysis = await openai_gate.call(
+                lambda: openai_client().chat.completions.create(model=OPENAI_MODEL, messages=messages),
+                est,
+            )
+            openai_gate.settle(est, getattr(analysis.usage, "total_tokens", None))
+            record_usage(analysis.usage)
+            result = analysis.choices[0].message.content
+        except Exception as e:
+            logging.error("OpenAI image request failed: %s", e)
+            return await update.message.reply_text("⚠️ Nepavyko gauti atsakymo iš modelio.")
+        if result:
+            await response_cache.set(f"image:{digest}", result, CACHE_TTL["image"])
+            await response_cache.set(f"image:{photo.file_unique_id}", result, CACHE_TTL["image"])
     context.user_data["last_reply"] = result
     await update.message.reply_text(result)
-    log_interaction(update.effective_user.id, path, result, "image")
+    log_interaction(update.effective_user.id, f"photo:{digest[:16]}", result, "image")
 # Generic message
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logging.debug("Message from %s in %s: %s", update.effective_user.id, update.message.chat.type, update.message.text)
-    if not increment_usage(update.effective_user.id):
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Message from %s in %s: %s", update.effective_user.id, update.message.chat.type, update.message.text)
+    if not await increment_usage(update.effective_user.id):
         return await quota_exceeded(update, context)
     user_msg = update.message.text
     if "profile" not in context.user_data and not context.user_data.get("profile_prompted"):
@@ -686,33 +3141,40 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if BOT_USERNAME is None:
             # Bot username not yet initialized -> ignore group messages
             logging.debug("Bot username not initialized, ignoring message")
-            return
+            return await refund_usage()
         mention = f"@{BOT_USERNAME}"
         if not (mention.lower() in user_msg.lower() or update.message.reply_to_message):
             logging.debug("Message in group without mention, ignoring")
-            return
+            return await refund_usage()
         user_msg = user_msg.replace(mention, "", 1).strip()
-    low = user_msg.lower()
-    lang_code = context.user_data.get("profile", {}).get("language", detect_language(user_msg))
+    intent, topic = intent_router.route(user_msg)
+    # Kontekstas – tik asmeniniame pokalbyje: grupėje nerodome privačių replikų ir atvirkščiai
+    private = update.message.chat.type == "private"
     user_progress[update.effective_user.id] = user_progress.get(update.effective_user.id, 0) + 1
-    if any(k in low for k in ["testas", "užduotys", "pasitikrink"]):
-        topic = strip_keywords(user_msg, ["testas", "užduotys", "pasitikrink"])
+    delivered = False
+    if intent == "quiz":
         reply = await generate_quiz(topic or user_msg, context)
-    elif any(k in low for k in ["flashcards", "kortelės", "atmintinė"]):
+    elif intent == "flashcards":
         if not has_feature(update.effective_user.id, "flashcards"):
             return await restricted_feature(update, context, "flashcards")
-        topic = strip_keywords(user_msg, ["flashcards", "kortelės", "atmintinė"])
         reply = await generate_flashcards(topic or user_msg, context)
-    elif any(k in low for k in ["konspektas", "santrauka", "paaiškink"]):
-        topic = strip_keywords(user_msg, ["konspektas", "santrauka", "paaiškink"])
-        reply = await generate_notes(topic or user_msg, context)
-    elif re.match(r"^10.\d{4,9}/[-._;()/:A-Z0-9]+$", user_msg, re.I):
+    elif intent == "notes":
+        reply = await generate_notes(topic or user_msg, context, update.message)
+        delivered = True
+    elif intent == "literature":
         reply = await analyze_literature(user_msg, context)
     else:
-        reply = await ask_openai(user_msg, lang_code)
+        lang_code = await user_language(context, user_msg)
+        history = conversation_context(update.effective_user.id)[0] if private else []
+        reply = await reply_streamed(update.message, user_msg, lang_code, context_messages=history)
         context.user_data["last_reply"] = reply
-    await update.message.reply_text(reply)
-    log_interaction(update.effective_user.id, user_msg, reply)
+        delivered = True
+    if not delivered:
+        await update.message.reply_text(reply)
+    meta = await content_meta(context, topic or user_msg) if intent in ("quiz", "flashcards") else {}
+    log_interaction(update.effective_user.id, user_msg, reply, intent or "", update.message.chat_id, **meta)
+    if intent is None and private:
+        maybe_summarize(update.effective_user.id, lang_code)
     logging.debug("Replied to %s", update.effective_user.id)
 # ──────────────────────────── Helpers ──────────────────────────────
 async def quota_exceeded(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -726,21 +3188,125 @@ async def restricted_feature(update: Update, context: ContextTypes.DEFAULT_TYPE,
     await update.message.reply_text(
         f"🔒 Ši funkcija prieinama nuo {TIER_NAMES[min_tier]}. Naudok /upgrade."
     )
+def update_owner(update: Update) -> int:
+    """Worker serving the update: all updates of one user go to the same process."""
+    user = update.effective_user
+    return user.id % WEBHOOK_WORKERS if user else 0
+
+
+async def forward_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before everything else: another worker's update is posted to its webhook, not handled here."""
+    from telegram.ext import ApplicationHandlerStop
+
+    owner = update_owner(update)
+    if owner == WORKER_INDEX:
+        return
+    url = WORKER_URL.format(index=owner, port=WEBHOOK_PORT + owner, path=WEBHOOK_PATH)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    deadline = time.monotonic() + WORKER_FORWARD_TIMEOUT
+    delay = 0.5
+    while True:
+        try:
+            resp = await shared_http_client().post(url, json=update.to_dict(), headers=headers)
+            resp.raise_for_status()
+            break
+        except Exception as e:
+            if time.monotonic() + delay > deadline:
+                logging.error("Update %s not forwarded to worker %d: %s", update.update_id, owner, e)
+                break
+            # savininkas gali būti perkraunamas – laukiame, kol vėl priims
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5.0)
+    raise ApplicationHandlerStop
+async def load_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before every other handler: pull the user's rows into RAM."""
+    if update.effective_user:
+        current_user_id.set(update.effective_user.id)
+        await storage.load_user(update.effective_user.id)
+def iter_handlers(app: Application) -> Iterator:
+    """Every registered leaf handler, including conversation entry points, states and fallbacks."""
+    from telegram.ext import ConversationHandler
+
+    def walk(handler):
+        if isinstance(handler, ConversationHandler):
+            for states in (handler.entry_points, *handler.states.values(), handler.fallbacks):
+                for h in states:
+                    yield from walk(h)
+        else:
+            yield handler
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            yield from walk(handler)
+def instrument_handlers(app: Application) -> None:
+    """Wrap every registered handler callback with @instrumented."""
+    for handler in iter_handlers(app):
+        if not hasattr(handler.callback, "__wrapped__"):
+            handler.callback = instrumented()(handler.callback)
 async def post_init(app: Application) -> None:
     """Retrieve bot username after initialization."""
-    global BOT_USERNAME
+    global BOT_USERNAME, metrics_server, precompute_task
+    asyncio.get_running_loop().set_default_executor(blocking_pool())
+    openai_client()
+    if LOOP_BLOCK_THRESHOLD > 0:
+        loop_watchdog.start()
+    if METRICS_PORT:
+        metrics.collector(lambda: [("medic_update_queue_size", "gauge", {}, app.update_queue.qsize())])
+        try:
+            metrics_server = await metrics.start_server(METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+        except OSError as e:
+            logging.error("Metrics server failed to start: %s", e)
+    await run_blocking(init_language_detector)  # profilių įkėlimas užtrunka ~0,1 s
+    await run_blocking(_token_encoder)  # tiktoken gali parsisiųsti žodyną – ne įvykių cikle
+    await storage.open()
+    analytics.open()
+    feed_cache.start()
+    reminder_scheduler.start(app.bot)
+    await content_library.open()
+    if PRECOMPUTE_INTERVAL > 0:
+        precompute_task = asyncio.create_task(_precompute_loop())
     me = await app.bot.get_me()
     BOT_USERNAME = me.username.lower()
     logging.debug("Initialized bot username: %s", BOT_USERNAME)
+async def post_shutdown(app: Application) -> None:
+    """Flush pending writes before exit."""
+    feed_cache.stop()
+    reminder_scheduler.stop()
+    if precompute_task is not None:
+        precompute_task.cancel()
+    if metrics_server is not None:
+        metrics_server.close()
+    await storage.close()
+    await close_http_clients()
+    loop_watchdog.stop()
+    shutdown_executors()
 # ─────────────────────────── Main entry ───────────────────────────
-if __name__ == "__main__":
-    app = (
+def build_application(token: str | None = TELEGRAM_TOKEN, request=None, get_updates_request=None) -> Application:
+    """Application with every handler registered; request objects can be swapped (e.g. bench.py)."""
+    setup_logging()
+    from telegram.ext import (
+        ApplicationBuilder,
+        CommandHandler,
+        ConversationHandler,
+        MessageHandler,
+        TypeHandler,
+        filters,
+    )
+
+    builder = (
         ApplicationBuilder()
-        .token(TELEGRAM_TOKEN)
-        .concurrent_updates(True)
+        .token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
         .post_init(post_init)
-        .build()
+        .post_shutdown(post_shutdown)
     )
+    if request is None:
+        request, get_updates_request = telegram_requests()
+    builder = builder.request(request).get_updates_request(get_updates_request or request)
+    app = builder.build()
+    if WEBHOOK_WORKERS > 1:
+        app.add_handler(TypeHandler(Update, forward_update), group=-2)
+    app.add_handler(TypeHandler(Update, load_user_state), group=-1)
     # Conversation handlers
     app.add_handler(ConversationHandler(
         entry_points=[CommandHandler("profile", profile)],
@@ -802,6 +3368,7 @@ if __name__ == "__main__":
     # Simple command handlers
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("review", review))
+    app.add_handler(CommandHandler("explain", explain))
     app.add_handler(CommandHandler("export_pdf", export_pdf))
     app.add_handler(CommandHandler("export_test", export_test))
     app.add_handler(CommandHandler("export_history", export_history))
@@ -827,8 +3394,45 @@ if __name__ == "__main__":
     text_filter = filters.TEXT & ~filters.COMMAND
     app.add_handler(MessageHandler(filters.ChatType.GROUPS & text_filter, handle_message))
     app.add_handler(MessageHandler(filters.ChatType.PRIVATE & text_filter, handle_message))
+    instrument_handlers(app)
+    return app
+async def _precompute_cli() -> None:
+    setup_logging()
+    openai_client()
+    await content_library.open()
+    try:
+        await precompute_popular()
+    finally:
+        await close_http_clients()
+if __name__ == "__main__":
+    if sys.argv[1:] == ["precompute"]:
+        # Vienkartinis paleidimas (pvz. cron): python medic_assistant.py precompute
+        asyncio.run(_precompute_cli())
+        raise SystemExit
+    app = build_application()
     logging.info("🤖 Medic Assistant veikia su prenumeratomis + admin išimtimis.")
-    app.run_polling(drop_pending_updates=True)
+    # Neatmetame per diegimą susikaupusių update; stop() apdoroja eilę iki galo
+    if WEBHOOK_WORKERS > 1 and BOT_MODE != "webhook":
+        raise SystemExit("WEBHOOK_WORKERS > 1 requires BOT_MODE=webhook")
+    if not 0 <= WORKER_INDEX < WEBHOOK_WORKERS:
+        raise SystemExit(f"WORKER_INDEX must be in 0..{WEBHOOK_WORKERS - 1}")
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("BOT_MODE=webhook requires WEBHOOK_URL")
+        if not WEBHOOK_SECRET:
+            logging.warning("WEBHOOK_SECRET not set: webhook requests are not authenticated")
+        # Visi darbininkai registruoja tą patį adresą; balansuotojas jį skirsto į WEBHOOK_PORT + i
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT + WORKER_INDEX,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=False,
+        )
+    else:
+        app.run_polling(drop_pending_updates=False)
 
  
  
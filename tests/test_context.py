@@ -0,0 +1,29 @@
+import medic_assistant as ma
+
+
+def _turn(q: str, t: float, chat_id: int | None = None) -> dict:
+    turn = {"q": q, "a": "ok", "f": "message", "t": t, "n": 2}
+    if chat_id is not None:
+        turn["c"] = chat_id
+    return turn
+
+
+def _questions(messages: list[dict]) -> list[str]:
+    return [m["content"] for m in messages if m["role"] == "user"]
+
+
+def test_context_uses_only_private_turns(monkeypatch):
+    monkeypatch.setattr(ma, "user_history", {7: [_turn("senas", 1), _turn("grupėje", 2, -100), _turn("asmeniškai", 3, 7)]})
+    monkeypatch.setattr(ma, "conversation_summaries", {})
+    messages, _ = ma.conversation_context(7)
+    assert _questions(messages) == ["senas", "asmeniškai"]
+
+
+def test_resetcontext_drops_summary_and_earlier_turns(monkeypatch):
+    monkeypatch.setattr(ma, "user_history", {7: [_turn("prieš", 1, 7), _turn("po", 3, 7)]})
+    monkeypatch.setattr(ma, "conversation_summaries", {7: {"text": "santrauka", "until": 2, "reset": 2}})
+    messages, pending = ma.conversation_context(7)
+    assert _questions(messages) == ["po"] and not pending
+    assert messages[0]["content"].endswith("santrauka")
+    ma.conversation_summaries[7] = {"reset": 4}
+    assert ma.conversation_context(7) == ([], [])
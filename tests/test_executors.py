@@ -0,0 +1,19 @@
+import asyncio
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import medic_assistant as ma
+
+
+def test_broken_process_pool_is_replaced():
+    async def scenario():
+        try:
+            with pytest.raises(BrokenProcessPool):
+                await ma.run_process(os._exit, 1)  # darbininkas nutrūksta ir per pakartojimą
+            assert await ma.run_process(pow, 2, 3) == 8
+        finally:
+            ma.shutdown_executors()
+
+    asyncio.run(scenario())
@@ -0,0 +1,36 @@
+import asyncio
+import os
+import pathlib
+
+import medic_assistant as ma
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "guideline_feed.xml")
+
+
+def _refresh(url: str) -> ma.FeedCache:
+    cache = ma.FeedCache({"ecdc": url})
+    asyncio.run(cache.refresh("ecdc"))
+    return cache
+
+
+def test_refresh_reads_local_fixture():
+    cache = _refresh(FIXTURE)
+    assert [e["title"] for e in cache.entries["ecdc"]] == [
+        "Antimicrobial resistance surveillance in Europe",
+        "Seasonal influenza vaccination recommendations",
+        "Measles outbreak risk assessment",
+    ]
+    assert cache.entries["ecdc"][0]["link"].startswith("https://www.ecdc.europa.eu/")
+    assert "ecdc" in cache.updated
+
+
+def test_refresh_reads_file_url():
+    cache = _refresh(pathlib.Path(FIXTURE).as_uri())
+    assert len(cache.entries["ecdc"]) == 3
+
+
+def test_missing_feed_keeps_previous_entries(tmp_path):
+    cache = _refresh(FIXTURE)
+    cache.feeds["ecdc"] = str(tmp_path / "missing.xml")
+    asyncio.run(cache.refresh("ecdc"))
+    assert len(cache.entries["ecdc"]) == 3
@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from telegram import Bot, Update
+from telegram.ext import ApplicationHandlerStop
+
+import medic_assistant as ma
+
+
+def _update(user_id: int) -> Update:
+    data = {
+        "update_id": 5,
+        "message": {
+            "message_id": 1, "date": 1700000000, "text": "labas",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "A"},
+        },
+    }
+    return Update.de_json(data, Bot("1:x"))
+
+
+def test_update_of_another_worker_is_forwarded_until_accepted(monkeypatch):
+    monkeypatch.setattr(ma, "WEBHOOK_WORKERS", 2)
+    monkeypatch.setattr(ma, "WORKER_INDEX", 0)
+    monkeypatch.setattr(ma, "WEBHOOK_SECRET", "s3cret")
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        return httpx.Response(503 if len(seen) == 1 else 200)  # pirmą kartą savininkas dar kyla
+
+    async def scenario():
+        monkeypatch.setattr(ma, "http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        try:
+            await ma.forward_update(_update(8), None)  # lyginis – savas, nepersiunčiamas
+            with pytest.raises(ApplicationHandlerStop):
+                await ma.forward_update(_update(7), None)
+        finally:
+            await ma.http_client.aclose()
+
+    asyncio.run(scenario())
+    assert len(seen) == 2
+    request = seen[-1]
+    assert request.url == f"http://127.0.0.1:{ma.WEBHOOK_PORT + 1}/{ma.WEBHOOK_PATH}"
+    assert request.headers["X-Telegram-Bot-Api-Secret-Token"] == "s3cret"
+    assert json.loads(request.content)["message"]["from"]["id"] == 7
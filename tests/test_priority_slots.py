@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+import medic_assistant as ma
+
+
+def test_waiter_cancelled_after_release_hands_the_slot_back():
+    async def scenario():
+        slots = ma.PrioritySlots(1)
+        await slots.acquire(0)
+        waiter = asyncio.create_task(slots.acquire(0))
+        await asyncio.sleep(0)
+        assert slots.queued == {0: 1}
+        slots.release()  # vieta atiduota laukiančiajam, bet jis dar nepabudo
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert slots.active == 0 and not slots.queued
+        await asyncio.wait_for(slots.acquire(0), 1)
+        assert slots.active == 1
+
+    asyncio.run(scenario())
+
+
+async def _order(slots: ma.PrioritySlots, priorities: list[int], pause: float = 0.0) -> list[int]:
+    granted: list[int] = []
+
+    async def wait(priority: int) -> None:
+        await slots.acquire(priority)
+        granted.append(priority)
+        slots.release()
+
+    tasks = []
+    for priority in priorities:
+        tasks.append(asyncio.create_task(wait(priority)))
+        await asyncio.sleep(pause)
+    slots.release()
+    await asyncio.gather(*tasks)
+    return granted
+
+
+def test_premium_goes_before_free():
+    async def scenario():
+        slots = ma.PrioritySlots(1)
+        await slots.acquire(0)
+        return await _order(slots, [0, 3, 0, 3])
+
+    assert asyncio.run(scenario()) == [3, 3, 0, 0]
+
+
+def test_long_waiting_free_user_overtakes_premium(monkeypatch):
+    monkeypatch.setattr(ma, "PRIORITY_AGING_SECONDS", 0.01)
+
+    async def scenario():
+        slots = ma.PrioritySlots(1)
+        await slots.acquire(0)
+        return await _order(slots, [0, 3], pause=0.1)  # Free amžiaus priedas viršija Premium pranašumą
+
+    assert asyncio.run(scenario()) == [0, 3]
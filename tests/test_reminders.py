@@ -0,0 +1,22 @@
+import asyncio
+import time
+
+import medic_assistant as ma
+
+
+def test_worker_keeps_own_reminders_and_ids_do_not_collide():
+    async def scenario():
+        reminders = ma.PersistentDict("reminders", per_user=False)
+        far = time.time() + 3600
+        for rid, user in ((1, 10), (2, 11), (4, 13)):
+            dict.__setitem__(reminders, rid, {"user": user, "chat": user, "text": "x", "due": far, "interval": 0})
+        scheduler = ma.ReminderScheduler(reminders, 1, 2)
+        scheduler.start(bot=None)
+        try:
+            assert sorted(reminders) == [2, 4]  # 11 ir 13 – nelyginiai
+            assert not reminders.dirty  # svetimi neištrinami iš DB
+            assert [scheduler.add(11, 11, "y", far) for _ in range(2)] == [5, 7]
+        finally:
+            scheduler.stop()
+
+    asyncio.run(scenario())
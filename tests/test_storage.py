@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+import pytest
+
+import medic_assistant as ma
+
+
+def _tables():
+    return (
+        ma.PersistentDict("user_tiers"),
+        ma.PersistentDict("health_metrics"),
+        ma.PersistentDict("user_progress"),
+        ma.PersistentDict("rooms", per_user=False),
+        ma.PersistentDict("feature_totals", per_user=False, counter=True),
+    )
+
+
+async def _seed(path: str, rows: list[tuple[str, str, str]], updated: float) -> None:
+    storage = ma.Storage(path, list(_tables()))
+    await storage._run(storage._connect)
+    await storage._run(storage._write, rows, updated)
+    await storage.close()
+
+
+def test_warm_load_keeps_old_rows_of_active_users(tmp_path, monkeypatch):
+    path = str(tmp_path / "storage.sqlite")
+    month_ago = time.time() - 30 * 86400
+
+    async def scenario():
+        await _seed(path, [("user_tiers", "7", "3"), ("health_metrics", "7", '{"svoris": {"__ts__": [1], "v": [80.0]}}')], month_ago)
+        await _seed(path, [("user_tiers", "8", "2")], month_ago)
+        await _seed(path, [("user_progress", "7", "5")], time.time())  # neseniai kalbėjo
+        storage = ma.Storage(path, list(_tables()))
+        tiers, health, _, _, _ = storage.tables.values()
+        await storage.open()
+        try:
+            monkeypatch.setattr(ma, "user_tiers", tiers)
+            assert tiers.get(7) == 3
+            assert ma.has_feature(7, "image_analysis")
+            assert list(health[7]["svoris"].values) == [80.0]
+            assert 8 not in tiers  # neaktyvus – kraunamas tik prireikus
+            await storage.load_user(8)
+            assert tiers[8] == 2
+        finally:
+            await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_keeps_keys_dirty(tmp_path, monkeypatch):
+    path = str(tmp_path / "storage.sqlite")
+
+    async def scenario():
+        tiers, health, progress, rooms, features = _tables()
+        storage = ma.Storage(path, [tiers, health, progress, rooms, features])
+        await storage.open()
+        try:
+            tiers[1] = 3
+            rooms["a"] = [1]
+
+            def broken(*args):
+                raise OSError("disk full")
+
+            monkeypatch.setattr(storage, "_write", broken)
+            with pytest.raises(OSError):
+                await storage.flush()
+            assert tiers.dirty == {1} and rooms.dirty == {"a"}
+            monkeypatch.undo()
+            await storage.flush()
+            assert not tiers.dirty and not rooms.dirty
+            rows = await storage._run(storage._select_key, "1")
+            assert rows == [("user_tiers", "3")]
+        finally:
+            await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_second_process_with_same_worker_index_is_refused(tmp_path):
+    path = str(tmp_path / "storage.sqlite")
+
+    async def scenario():
+        first = ma.Storage(path, list(_tables()), 0, 2)
+        await first.open()
+        try:
+            with pytest.raises(RuntimeError):
+                await ma.Storage(path, list(_tables()), 0, 2).open()
+            other = ma.Storage(path, list(_tables()), 1, 2)
+            await other.open()  # kitas darbininkas – leidžiama
+            await other.close()
+        finally:
+            await first.close()
+        second = ma.Storage(path, list(_tables()), 0, 2)
+        await second.open()  # užraktas atleistas
+        await second.close()
+
+    asyncio.run(scenario())
+
+
+def test_top_merges_unflushed_values_without_flushing(tmp_path):
+    path = str(tmp_path / "storage.sqlite")
+
+    async def scenario():
+        await _seed(path, [("user_tiers", str(u), str(u)) for u in range(1, 6)], time.time() - 30 * 86400)
+        storage = ma.Storage(path, list(_tables()))
+        tiers = storage.tables["user_tiers"]
+        await storage.open()
+        try:
+            await storage.load_user(2)
+            tiers[2] = 10  # dar neįrašyta
+            tiers[9] = 7
+            assert await storage.top("user_tiers", 3) == [(2, 10), (9, 7), (5, 5)]
+            assert tiers.dirty == {2, 9}  # top() nebeverčia įrašyti
+            del tiers[2]
+            assert await storage.top("user_tiers", 2) == [(9, 7), (5, 5)]
+        finally:
+            await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_workers_load_only_their_users_and_share_tables(tmp_path):
+    path = str(tmp_path / "storage.sqlite")
+
+    async def scenario():
+        await _seed(path, [("user_tiers", "1", "1"), ("user_tiers", "2", "2")], time.time())
+        first = ma.Storage(path, list(_tables()), 0, 2)
+        second = ma.Storage(path, list(_tables()), 1, 2)
+        await first.open()
+        await second.open()
+        try:
+            assert dict(first.tables["user_tiers"]) == {2: 2}
+            assert dict(second.tables["user_tiers"]) == {1: 1}
+            # bendra lentelė keičiama atomiškai, kitas darbininkas pamato po refresh
+            await first.update("rooms", "a", lambda members: (members or []) + [2])
+            await second.update("rooms", "a", lambda members: (members or []) + [1])
+            await first.refresh("rooms")
+            assert first.tables["rooms"]["a"] == [2, 1]
+            # skaitikliai sumuojami, o ne perrašomi
+            first.tables["feature_totals"]["quiz"] = 3
+            second.tables["feature_totals"]["quiz"] = 2
+            await first.flush()
+            await second.flush()
+            second.tables["feature_totals"]["quiz"] += 1
+            await second.refresh("feature_totals")
+            assert second.tables["feature_totals"]["quiz"] == 6
+            await second.flush()
+            await first.refresh("feature_totals")
+            assert first.tables["feature_totals"]["quiz"] == 6
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(scenario())